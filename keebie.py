@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 #Keebie by Robin Universe & Friends
 
-from evdev import InputDevice, categorize, ecodes
+from evdev import InputDevice, UInput, UInputError, ecodes, list_devices
 import sys
 import signal
 import os
@@ -10,6 +10,17 @@ import argparse
 import time
 import subprocess
 import shutil
+import csv
+import heapq
+import mmap
+import struct
+import fcntl
+import ctypes
+import tempfile
+import socket
+import shlex
+import pickle
+import re
 
 
 
@@ -20,13 +31,55 @@ printDebugs = False # Whether we should print debug information
 # Hide some output not strictly needed for interactivity
 quietMode = False
 
-def dprint(*args, **kwargs): # Print debug info (or don't)
-    if printDebugs == True :
-        print(*args, **kwargs)
+# Write log output as JSON lines instead of text
+jsonLogs = False
 
-def qprint(*args, **kwargs): # Print less then necessary info (or don't)
-    if quietMode == False :
-        print(*args, **kwargs)
+logDebug, logInfo, logNotice = 10, 20, 30 # Levels of log records, debug records are printed with --verbose, info records unless --quiet, and notices always
+logLevelNames = {logDebug: "debug", logInfo: "info", logNotice: "notice"}
+
+logRingSize = 2048 # How many recent log records are kept in memory whether or not they were printed
+logRing = [None, ] * logRingSize # A ring buffer of (timestamp, level, message, args) log records
+logRingIndex = 0 # How many records have ever been logged, the next one goes into logRing[logRingIndex % logRingSize]
+
+def log(level, message = "", *args):
+    """Record a log message in our ring buffer and print it if its level is enabled.
+
+    message is a str.format() template for args and is only formatted if the record is printed or dumped, so hot paths should pass args rather than f-strings (and shouldn't change them afterwards).
+    Records are only ever added by the thread running the loop, so the ring needs no lock."""
+    global logRingIndex
+
+    logRing[logRingIndex % logRingSize] = (time.time(), level, message, args)
+    logRingIndex += 1
+
+    if level == logDebug and printDebugs == False or level == logInfo and quietMode == True: # If the level isn't enabled
+        return # We're done, the record will only be formatted if the ring is dumped
+
+    print(formatLog(logRing[(logRingIndex - 1) % logRingSize]))
+
+def formatLog(record, asJson = None):
+    """Return a log record formatted as text, or as a JSON object if asJson (jsonLogs by default) is set."""
+    timestamp, level, message, args = record
+
+    text = message.format(*args) if not args == () else str(message)
+    if asJson == True or asJson == None and jsonLogs == True:
+        return json.dumps({"time": timestamp, "level": logLevelNames[level], "message": text})
+
+    return text
+
+def dumpLog(path):
+    """Write all log records in our ring buffer to a file as JSON lines, oldest first."""
+    start = max(0, logRingIndex - logRingSize)
+    lines = [formatLog(logRing[index % logRingSize], True) for index in range(start, logRingIndex)]
+
+    with open(path + ".tmp", "wt") as dumpFile: # Write a temporary file and move it into place so readers never see half a dump
+        dumpFile.write("".join([line + "\n" for line in lines]))
+    os.replace(path + ".tmp", path)
+
+def dprint(message = "", *args): # Log debug info (printed or not)
+    log(logDebug, message, *args)
+
+def qprint(message = "", *args): # Log less then necessary info (printed or not)
+    log(logInfo, message, *args)
 
 # Global vars
 
@@ -39,6 +92,10 @@ deviceDir = dataDir + "devices/" # Cache the full path to the /devices directory
 scriptDir = dataDir + "scripts/" # Cache the full path to the /scripts directory
 
 pidPath = dataDir + "running.pid" # A Path into which we should store the PID of a running looping instance of keebie
+signalVersion = 1 # Written to the PID file after our PID, tells other instances which signals we handle (PID files without one are from instances that only handle SIGINT, SIGUSR1 and SIGUSR2)
+logDumpPath = os.environ.get("XDG_RUNTIME_DIR", dataDir.rstrip("/")) + "/keebie.log" # A path into which a running looping instance dumps its recent log records
+journalDumpPath = os.environ.get("XDG_RUNTIME_DIR", dataDir.rstrip("/")) + "/keebie.journal" # A path into which a running looping instance dumps its journal of recent commands
+journalPath = dataDir + "journal.log" # A path to which commands are journaled if the journalFile setting is True
 
 
 
@@ -53,7 +110,7 @@ havePaused = False # A bool to store if this process has been signaled to pause
 def signal_handler(signal, frame):
     end()
 
-def end(): # Properly close the device file and exit the script
+def end(status = 0): # Properly close the device file and exit the script with status
     qprint() # Make sure there is a newline
 
     if devicesAreGrabbed == True: # If we need to clean up grabbed macroDevices
@@ -64,23 +121,101 @@ def end(): # Properly close the device file and exit the script
         sendResume() # Tell it to resume
 
     if savedPid == True: # If we have writen to the PID file
+        notifyService("STOPPING=1") # Let systemd know we're stopping on purpose
         removePid() # Remove our PID files
 
-    sys.exit(0) # Exit without error
+    if not state == None: # If we have published our state
+        state.close() # Remove the state file
+
+    stopWorkers() # Stop any worker processes we supervise
+
+    closeVirtualKeyboard() # Release any keys a macro is holding
+
+    sys.exit(status) # Exit, without error unless told otherwise
+
+
+
+# Timers
+
+class timerScheduler():
+    """A class for running callbacks at set times from the main loop, independent of how often the loop ticks."""
+    def __init__(self):
+        self.timers = [] # A heap of timers, each a list of [due timestamp, id, callback, args]
+        self.nextId = 0 # An id to keep timers with the same due timestamp in the order they were scheduled
+
+    def scheduleAt(self, due, callback, *args):
+        """Schedule callback(*args) to run at the timestamp due and return the timer."""
+        timer = [due, self.nextId, callback, args]
+        self.nextId += 1
+
+        heapq.heappush(self.timers, timer) # Add the timer to our heap
+        return timer
+
+    def schedule(self, delay, callback, *args):
+        """Schedule callback(*args) to run in delay seconds and return the timer."""
+        return self.scheduleAt(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        """Cancel a timer returned by schedule() or scheduleAt()."""
+        if not timer == None:
+            timer[2] = None # Mark the timer as cancelled, it will be discarded when it comes due
+
+    def run(self):
+        """Run the callbacks of all timers that are due."""
+        now = time.time()
+
+        while not self.timers == [] and self.timers[0][0] <= now: # While the earliest timer is due
+            due, timerId, callback, args = heapq.heappop(self.timers) # Pop it
+
+            if not callback == None: # If it wasn't cancelled
+                callback(*args) # Run it
+
+    def sleepTime(self, maxSleep):
+        """Return how long the main loop may sleep without delaying a timer, at most maxSleep."""
+        while not self.timers == [] and self.timers[0][2] == None: # Discard cancelled timers
+            heapq.heappop(self.timers)
+
+        if self.timers == []: # If there are no timers
+            return maxSleep
+
+        return max(0, min(maxSleep, self.timers[0][0] - time.time()))
+
+scheduler = timerScheduler() # The scheduler used by the main loop
 
 
 
 # Key Ledger
 
+keyNames = {} # A dict of key names by key code, for keys with several names the first one
+for code, name in ecodes.keys.items():
+    keyNames[code] = name[0] if type(name) in (list, tuple) else name
+
+keyUp, keyDown, keyHold = 0, 1, 2 # Values of EV_KEY events
+
+axisNames = {ecodes.EV_REL: {}, ecodes.EV_ABS: {}} # Dicts of axis names by code for relative and absolute axes
+for code, name in ecodes.REL.items():
+    axisNames[ecodes.EV_REL][code] = name[0] if type(name) in (list, tuple) else name
+for code, name in ecodes.ABS.items():
+    axisNames[ecodes.EV_ABS][code] = name[0] if type(name) in (list, tuple) else name
+
+ledgerSettings = ("multiKeyMode", "holdThreshold", "flushTimeout") # Settings a ledger uses, which devices and layers may override
+
 class keyLedger():
     """A class for tracking which keys are pressed, as well how how long and how recently."""
+    handoverFields = ("state", "stateChangeStamp", "peaking", "autorepeats", "suppressPeak", "history", "histories", "downKeys") # Fields handed to a new instance by --restart
+
     def __init__(self, name="unnamed ledger"):
         self.name = name # Name of the ledger for debug prints
+        self.setTiming() # Start with the global settings
         
         self.state = 3 # An int representing the state of the ledger; 0, 1, 2, 3 : rising, falling, holding, stale
         self.stateChangeStamp = time.time() # The timestamp of the last state change
+        self.eventStamp = self.stateChangeStamp # The timestamp of the last key event, set before onRise is called
         self.peaking = False # Are we peaking (adding new keys; rising or holding)
         self.ignored_keys = []
+        self.autorepeats = 0 # How many kernel autorepeat events we got for our down keys since they last changed
+        self.suppressPeak = False # Set to keep the current peak out of our history (because a binding has already handled it)
+        self.onRise = None # A function called with the down keys str on the rising edge of the first peak of a history, returns True if it handled the peak
         
         self.history = "" # Current history of recent key peaks
         self.histories = [] # List of flushed histories
@@ -89,6 +224,12 @@ class keyLedger():
         self.lostKeys = [] # List of keys newly lost
         self.downKeys = [] # List of keys being held down
 
+    def setTiming(self, overrides = {}):
+        """Resolve the ledger settings we use from our settings and a dict overriding some of them, so events don't have to look them up."""
+        self.multiKeyMode = overrides.get("multiKeyMode", settings["multiKeyMode"]) # How multiple held keys are treated
+        self.holdThreshold = overrides.get("holdThreshold", settings["holdThreshold"]) # Seconds a peak must last to be recorded as held
+        self.flushTimeout = overrides.get("flushTimeout", settings["flushTimeout"]) # Seconds without keys before our history is flushed
+
     def newKeysStr(self):
         """Return a str of concatenated new keys."""
         keysParsed = ""
@@ -140,7 +281,7 @@ class keyLedger():
             entry = self.downKeysStr() # Use the currently down keys
 
         if held == None: # If the whether the key was held was not specified
-            held = self.stateDuration((timestamp)) > settings["holdThreshold"] # Set held True if the length of last state surpassed holdThreshold setting
+            held = self.stateDuration((timestamp)) > self.holdThreshold # Set held True if the length of last state surpassed holdThreshold setting
 
         entry += "+HELD" * held # If held is True note that into the entry
 
@@ -149,12 +290,12 @@ class keyLedger():
 
         self.history += entry # Add entry to our history
 
-        dprint(f"{self.name}) added {entry} to history")
+        dprint("{}) added {} to history", self.name, entry)
         # dprint(f"{self.name}) history is \"{self.history}\"")
 
     def flushHistory(self):
         """Flush our current history into our histories list."""
-        dprint(f"{self.name}) flushing {self.history}")
+        dprint("{}) flushing {}", self.name, self.history)
 
         self.histories += [self.history, ] # Add our history to our histories
         self.history = "" # Clear our history
@@ -162,14 +303,14 @@ class keyLedger():
     def popHistory(self):
         """Pop the nest item out of our histories list and return it, returns a blank string if no history is available."""
         try: # Try to..
-            dprint(f"{self.name}) popping {self.histories[0]}")
+            dprint("{}) popping {}", self.name, self.histories[0])
             return self.histories.pop(0) # Pop and return the first element of our histories list
 
         except IndexError: # If no history is available
             return "" # Return an empty string
 
     def update(self, events=()):
-        """Update the ledger with an iteratable of key events (or Nones to update timers)."""
+        """Update the ledger with an iteratable of raw (sec, usec, type, code, value) events (or Nones to update timers)."""
         flushedHistory = False # A bool to store if we flushed any histories this update
         
         for event in events: # For each passed event
@@ -178,52 +319,57 @@ class keyLedger():
 
             timestamp = None # A float (or None) for the timestamp of the event, will be passed to other methods
             if not event == None: # If the event is not None
-                timestamp = event.timestamp() # Set timestamp to the event's timestamp
+                sec, usec, eventType, code, keystate = event # Unpack the raw event
+                timestamp = sec + usec / 1000000 # Set timestamp to the event's timestamp
                 
-                if event.type == ecodes.EV_KEY: # If the event is a related to a key, as opposed to a mouse movement or something (At least I think thats what this does)
-                    event = categorize(event) # Convert our EV_KEY input event into a KeyEvent
-                    keycode = event.keycode # Store the event's keycode
-                    keystate = event.keystate # Store the event's key state
+                if eventType == ecodes.EV_KEY: # If the event is a related to a key, as opposed to a mouse movement or something
+                    self.eventStamp = timestamp # Record when it happened, bindings fired on the rising edge run before the state change below
+                    keycode = keyNames.get(code, "?") # Look up the name of the key
                     if keycode not in self.ignored_keys:  # Ignore keycodes
                         # dprint(timestamp)
 
-                        if type(keycode) == list: # If the keycode is a list of keycodes (it can happen) 
-                            keycode = keycode[0] # Select the first one
-
-                        if keystate in (event.key_down, event.key_hold): # If the key is down
+                        if keystate in (keyDown, keyHold): # If the key is down
                             if not keycode in self.downKeys: # If the key is not known to be down
                                 self.newKeys += [keycode, ] # Add the key to our new keys
 
-                        elif keystate == event.key_up: # If the key was released
+                            elif keystate == keyHold: # If the kernel is autorepeating a key we know is down
+                                self.autorepeats += 1 # Count it
+
+                        elif keystate == keyUp: # If the key was released
                             if keycode in self.downKeys: # If the key was in our down keys
                                 self.lostKeys += [keycode, ] # Add the key to our lost keys
 
                             else: # If the key was not known to be down
-                                print(f"{self.name}) Untracked key {keycode} released.") # Print a warning
+                                log(logNotice, "{}) Untracked key {} released.", self.name, keycode) # Print a warning
                     else:
-                        dprint(f"{self.name}) (Ignoring key {keycode})") # Print a warning
+                        dprint("{}) (Ignoring key {})", self.name, keycode) # Print a warning
 
             if not self.newKeys == []: # if we have new keys (rising edge)
                 # dprint()
-                dprint(f"{self.name}) >{'>' * len(self.downKeys)} " \
-                    f"rising with new keys {self.newKeysStr()}")
+                dprint("{}) >{} rising with new keys {}", self.name, ">" * len(self.downKeys), self.newKeysStr())
                 
                 self.downKeys += self.newKeys # Add our new keys to our down keys
                 self.peaking = True # Store that we are peaking
+                self.autorepeats = 0 # This is a new peak
+                self.suppressPeak = False
 
-                if settings["multiKeyMode"] == "combination": # If we are in combination mode
+                if self.multiKeyMode == "combination": # If we are in combination mode
                     self.downKeys.sort() # Sort our down keys to negate the order they were added in
+
+                if not self.onRise == None and self.history == "": # If someone wants to handle peaks as soon as they start
+                    self.suppressPeak = self.onRise(self.downKeysStr()) # Let them, and leave the peak out of our history if they did
                 
                 self.stateChange(0, timestamp) # Change to state 0
 
             elif not self.lostKeys == []: # If we lost keys (falling edge)
                 # dprint()
-                dprint(f"{self.name}) {'<' * len(self.downKeys)}" \
-                    f" falling with lost keys {self.lostKeysStr()}")
+                dprint("{}) {} falling with lost keys {}", self.name, "<" * len(self.downKeys), self.lostKeysStr())
 
                 if self.peaking == True: # If we were peaking
-                    self.addHistoryEntry(timestamp=timestamp) # Add current down keys (peak keys) to our history
+                    if self.suppressPeak == False: # If the peak wasn't already handled
+                        self.addHistoryEntry(timestamp=timestamp) # Add current down keys (peak keys) to our history
                     self.peaking = False # We are no longer peaking
+                    self.autorepeats = 0
                     
                 for keycode in self.lostKeys: # For each lost key
                     self.downKeys.remove(keycode) # Remove it from our down keys
@@ -245,7 +391,7 @@ class keyLedger():
 
                 self.stateChange(3, timestamp) # Change to state 3
 
-                if self.stateDuration(timestamp) > settings["flushTimeout"] and not self.history == "": # If the duration of this stale state has surpassed flushTimeout setting
+                if self.stateDuration(timestamp) > self.flushTimeout and not self.history == "": # If the duration of this stale state has surpassed flushTimeout setting
                     # dprint()
                     self.flushHistory() # Flush our current history
                     flushedHistory = True # Store that we did so
@@ -254,8 +400,122 @@ class keyLedger():
 
 
 
+# Debouncing
+
+debounceModes = ("eager", "deferred") # The modes a keyDebouncer supports
+
+def validDebounceWindow(window): # Return True if a debounce window from a device file is a non-negative number of milliseconds
+    return type(window) in (int, float) and window >= 0
+
+class keyDebouncer():
+    """A class for filtering switch bounce (chatter) out of raw key events before they reach a ledger.
+
+    In eager mode a key change is passed on right away and further changes of the key are held back for its window.
+    In deferred mode a key change is only passed on once the key has stayed in its new state for its window.
+    Either way a key that ends up in a different state than the one passed on gets a synthesized event once the window ends."""
+    def __init__(self, name, config):
+        self.name = name # Name of the debouncer for debug prints
+        self.mode = config.get("mode", "eager") # "eager" or "deferred"
+        self.window = config.get("window", 5) # The default window in seconds (configured in ms)
+
+        if not self.mode in debounceModes or not validDebounceWindow(self.window): # If the mode or window is misspelled (the filter can't handle either)
+            log(logNotice, "{}) Invalid debounce mode {!r} or window {!r}, using eager mode with a 5ms window", self.name, self.mode, self.window)
+            self.mode, self.window = "eager", 5
+
+        self.window /= 1000
+
+        self.windows = {} # A dict of per key windows in seconds by key code
+        for keyName, window in config.get("keys", {}).items():
+            if not keyName in ecodes.ecodes or not validDebounceWindow(window): # If the key name is misspelled or the window isn't a time
+                log(logNotice, "{}) Invalid debounce key {} with window {!r}, ignoring it", self.name, keyName, window)
+                continue
+
+            self.windows[ecodes.ecodes[keyName]] = window / 1000
+
+        self.raw = {} # A dict of the last raw value of each key by code
+        self.reported = {} # A dict of the last value passed on for each key by code
+        self.changed = {} # A dict of when each key last changed (raw in deferred mode, reported in eager mode) by code
+        self.pending = set() # Codes of keys whose raw value differs from the reported one
+        self.wakeTimer = None # A scheduler timer to make sure the main loop is awake when a window ends
+
+    def filter(self, events):
+        """Return events with bounces removed, plus any key changes whose window has ended."""
+        filtered = []
+
+        for event in events:
+            sec, usec, eventType, code, value = event
+
+            if not eventType == ecodes.EV_KEY: # Only keys bounce
+                filtered += [event, ]
+                continue
+
+            if value == keyHold: # Pass on autorepeats only for keys we reported down
+                if self.reported.get(code, keyUp) == keyDown:
+                    filtered += [event, ]
+                continue
+
+            timestamp = sec + usec / 1000000
+            window = self.windows.get(code, self.window)
+            self.raw[code] = value
+
+            if self.mode == "eager" and timestamp - self.changed.get(code, 0) >= window: # If the key is not locked by a recent change
+                if not self.reported.get(code, keyUp) == value: # And this is a real change
+                    filtered += [event, ]
+                    self.reported[code] = value
+                    self.changed[code] = timestamp
+                self.pending.discard(code)
+                continue
+
+            if self.mode == "deferred":
+                self.changed[code] = timestamp # Restart the wait for the key to settle
+
+            if self.reported.get(code, keyUp) == value: # If the key bounced back
+                self.pending.discard(code)
+                dprint("{}) dropped bounce of {}", self.name, keyNames.get(code, code))
+            else: # If the key might have changed, decide when its window ends
+                self.pending.add(code)
+                self.wake(self.changed[code] + window)
+
+        return filtered + self.settle()
+
+    def settle(self):
+        """Return synthesized events for pending keys whose window has ended."""
+        events = []
+        now = time.time()
+
+        for code in list(self.pending):
+            window = self.windows.get(code, self.window)
+
+            if now - self.changed[code] >= window: # If the window has ended
+                events += [(int(now), int(now % 1 * 1000000), ecodes.EV_KEY, code, self.raw[code]), ]
+                self.reported[code] = self.raw[code]
+                self.changed[code] = now
+                self.pending.discard(code)
+
+            else: # Otherwise come back when it ends
+                self.wake(self.changed[code] + window)
+
+        return events
+
+    def wake(self, due):
+        """Make sure the main loop wakes up at due."""
+        if self.wakeTimer == None or self.wakeTimer[2] == None or due < self.wakeTimer[0]:
+            scheduler.cancel(self.wakeTimer)
+            self.wakeTimer = scheduler.scheduleAt(due, self.woken)
+
+    def woken(self):
+        self.wakeTimer = None
+
+
+
 # Macro device
 
+inputEvent = struct.Struct("llHHi") # The layout of a struct input_event read from a device file; sec, usec, type, code, value
+readBatchSize = 64 # How many events to read from a device with a single system call
+
+EVIOCSMASK = 0x40104593 # The ioctl request for setting which events the kernel delivers to a device file; _IOW('E', 0x93, struct input_mask)
+maskableTypes = (ecodes.EV_SYN, ecodes.EV_KEY, ecodes.EV_REL, ecodes.EV_ABS, ecodes.EV_MSC, ecodes.EV_SW, ecodes.EV_LED, ecodes.EV_SND, ecodes.EV_FF) # Event types EVIOCSMASK can mask
+
 class macroDevice():
     """A class for managing devices."""
     def __init__(self, deviceJson):
@@ -267,9 +527,42 @@ class macroDevice():
         self.udevMatchKeys = jsonData["udev_match_keys"] # Strings for udev matching
 
         self.currentLayer = self.initialLayer # Layer this device is currently on
+        self.ignoredKeys = jsonData["ignored_keys"] # Keys our ledger should ignore
         self.ledger = keyLedger(self.name) # A keyLedger to track input events on his devicet
-        self.ledger.ignored_keys = jsonData["ignored_keys"]
+        self.ledger.ignored_keys = self.ignoredKeys
+        self.groupName = jsonData.get("group", None) # The name of a group of devices sharing one ledger (and layer), if any
+        self.group = None # The deviceGroup we are a member of, set by setupDeviceGroups()
+
+        self.timing = validTiming(jsonData, f"device {self.name}") # Ledger settings this device overrides, layers may override them in turn
+
+        self.debouncer = None # A keyDebouncer for chattering switches, if the device needs one
+        if "debounce" in jsonData:
+            self.debouncer = keyDebouncer(self.name, jsonData["debounce"])
+
+        self.passthrough = jsonData.get("passthrough", False) # Whether keys without bindings (and remapped keys) should be re-emitted through the virtual keyboard
+        self.pendingAxes = {} # A dict of axis bindings that moved and their accumulated [delta, count, value, timestamp of the last event]
+        self.axisTimer = None # The scheduler timer ending the current axis dispatch window
+        self.policies = {} # A dict of the state of binding policies by (layer, keycode)
+        self.layerStack = [] # Layers we pushed from (with layer-push: and layer-hold:), the last one is returned to first
+        self.momentary = [] # A list of [set of key codes, layerStack depth, released] for layers held by layer-hold: bindings
+        self.forwardedKeys = {} # A dict of key codes we are forwarding and the codes we forward them as, so they are released even if the layer changes
         self.device = None # will be an InputEvent instance
+        self.eventTypes = {ecodes.EV_KEY, } # The event types we use, the kernel is asked to drop the rest
+        self.masked = False # Whether the kernel is masking events for us
+        self.readBuffer = bytearray(inputEvent.size * readBatchSize) # A reusable buffer for raw events
+        self.readView = memoryview(self.readBuffer) # And a view into it so we can slice it without copying
+        self.capabilities = {} # The capabilities of the device, cached when it is grabbed
+        self.autorepeat = False # Whether the kernel autorepeats keys on this device
+        self.ledCodes = [] # The LEDs the device has
+        self.ledsOn = set() # The LEDs we know to be on
+
+        self.repeatPeak = "" # The down keys str of the repeat binding we are currently firing, if any
+        self.repeatTimer = None # The scheduler timer for the next repeat, None if we follow kernel autorepeat instead
+        self.repeatCount = 0 # How many times the current repeat binding has fired
+
+        self.lastHistory = "" # The last history we processed
+        self.eventCount = 0 # How many input events we have read
+        self.dispatchCount = 0 # How many bound histories we have processed
 
     def addUdevRule(self, current_event_file = "", priority = 85):
         """Generate a udev rule for this device."""
@@ -284,66 +577,335 @@ class macroDevice():
 
         subprocess.run(["sudo", "sh", installDataDir + "/setup_tools/udevRule.sh", rule_string, self.eventFile, filepath, current_event_file]) # Run the udev setup script with sudo
         
-        subprocess.run(["sudo", "udevadm", "test", "/sys/class/input/event3"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) # Force udev to parse the new rule for the device
+        if not current_event_file == "": # If we know the device's node
+            subprocess.run(["sudo", "udevadm", "trigger", "--action=add", "/sys/class/input/" + os.path.basename(os.path.realpath(current_event_file))]) # Have udev apply the new rule to it
 
     def grabDevice(self):
         """Grab the device and set self.device to the grabbed device."""
-        qprint("grabbing device " + self.name)
+        qprint("grabbing device {}", self.name)
         self.device = InputDevice(self.eventFile) # Set self.device to the device of self.eventFile
-        self.device.grab() # Grab the device
+
+        if self.name in handedOver: # If a previous instance handed us the device already grabbed
+            self.adoptDevice(*handedOver.pop(self.name))
+        else:
+            self.device.grab() # Grab the device
+
+        preloadLayers(self.initialLayer) # Load (or create) every layer we can switch to now, rather than on a keypress
+        preloadLayers(self.currentLayer)
+        self.eventTypes = getLayerIndex(self.currentLayer, "eventTypes") # Find out which events our layer uses
+        self.setEventMask() # Only get those
+        self.resolveTiming() # And resolve our ledger settings for it
+        warmVars(self.currentLayer) # And start computing its dynamic vars
+
+        if self.passthrough == True: # If we'll be forwarding keys
+            getVirtualKeyboard() # Create the virtual keyboard now rather than on the first keystroke
+        self.capabilities = self.device.capabilities() # Cache what the device can do, asking is an ioctl walk over every event type
+        self.autorepeat = ecodes.EV_REP in self.capabilities # Check if the kernel autorepeats keys for us
+        self.ledCodes = self.capabilities.get(ecodes.EV_LED, []) # Get a list of LEDs the device has
+
+        if not self.ledCodes == []: # If the device has LEDs
+            self.ledsOn = set(self.device.leds()) # Find out which are currently on
 
         self.setLeds() # Set the leds based on the current layer
 
+    def resolveTiming(self):
+        """Resolve the ledger settings for our current layer, layer overrides win over our own, which win over settings."""
+        timing = dict(self.timing)
+        timing.update(getLayerIndex(self.currentLayer, "timing"))
+
+        dprint("{}) ledger settings for {} override {}", self.name, self.currentLayer, timing)
+        self.ledger.setTiming(timing)
+
+    def adoptDevice(self, grabbedFd, handoverState):
+        """Switch our device to a grabbed file descriptor (and the layer and ledger state) handed over by a previous instance, so no events are lost."""
+        os.dup2(grabbedFd, self.device.fd) # Make our device's fd refer to the grabbed open file, events queued on it are still there
+        os.close(grabbedFd)
+
+        self.currentLayer = handoverState["layer"]
+        self.layerStack = handoverState.get("stack", [])
+        for field, value in handoverState["ledger"].items():
+            setattr(self.ledger, field, value)
+
+        dprint("{}) adopted handed over device on layer {}", self.name, self.currentLayer)
+
+    def handoverState(self):
+        """Return a dict of the state a new instance needs to carry on where we stop."""
+        return {"layer": self.currentLayer, "stack": self.layerStack, "ledger": {field: getattr(self.ledger, field) for field in keyLedger.handoverFields}}
+
+    def setEventMask(self):
+        """Ask the kernel to only deliver the event types we use to our device file (and SYN_DROPPED)."""
+        allCodes = ctypes.create_string_buffer(b"\xff" * 96, 96) # A bitmask of event codes enabling every code (KEY_CNT is the largest count, 0x300 bits)
+        synDropped = ctypes.create_string_buffer(bytes([1 << ecodes.SYN_DROPPED, ]), 1) # A bitmask enabling only SYN_DROPPED
+        noCodes = ctypes.create_string_buffer(1) # A bitmask enabling no codes
+
+        for eventType in maskableTypes: # For all event types we can mask
+            if eventType in self.eventTypes: # Deliver all codes of the types we use
+                codesBuffer = allCodes
+            elif eventType == ecodes.EV_SYN: # Deliver only SYN_DROPPED of EV_SYN
+                codesBuffer = synDropped
+            else: # And nothing else
+                codesBuffer = noCodes
+
+            inputMask = struct.pack("IIQ", eventType, len(codesBuffer), ctypes.addressof(codesBuffer)) # Build a struct input_mask
+
+            try: # Try to...
+                fcntl.ioctl(self.device.fd, EVIOCSMASK, inputMask) # Set the mask
+            except OSError as error: # If the kernel doesn't support event masks
+                dprint("device {} can't mask events ({}), filtering them ourselves", self.name, error)
+                self.masked = False
+                return
+
+        self.masked = True
+
+    def updateEventMask(self):
+        """Update our event mask if the current layer uses different event types than the previous one."""
+        eventTypes = getLayerIndex(self.currentLayer, "eventTypes")
+
+        if not eventTypes == self.eventTypes: # If the event types we need changed
+            dprint("device {} now uses event types {}", self.name, eventTypes)
+            self.eventTypes = eventTypes
+            self.setEventMask()
+
+    def accumulateAxes(self, events):
+        """Add relative and absolute axis events to our pending axis bindings and return the other events."""
+        axes = getLayerIndex(self.currentLayer, "axes")
+        otherEvents = []
+
+        for event in events:
+            eventType, code, value = event[2:]
+
+            if eventType == ecodes.EV_REL: # If the event moved a relative axis (a wheel, dial or mouse)
+                axisName = axisNames[eventType].get(code, "?")
+                binding = axisName + ("+" if value > 0 else "-") # Bindings for one direction win over bindings for the whole axis
+                if not binding in axes:
+                    binding = axisName
+
+            elif eventType == ecodes.EV_ABS: # If the event moved an absolute axis (a slider or stick)
+                binding = axisNames[eventType].get(code, "?")
+
+            else: # If it isn't an axis event
+                otherEvents += [event, ]
+                continue
+
+            if binding in axes: # If the axis is bound
+                pending = self.pendingAxes.setdefault(binding, [0, 0, 0, 0]) # Get the accumulated [delta, count, value, timestamp] of the binding
+                pending[0] += value
+                pending[1] += abs(value) if eventType == ecodes.EV_REL else 1
+                pending[2] = value
+                pending[3] = event[0] + event[1] / 1000000
+
+        if not self.pendingAxes == {} and self.axisTimer == None: # If we aren't in a dispatch window
+            self.dispatchAxes() # Dispatch right away
+
+        return otherEvents
+
+    def dispatchAxes(self):
+        """Dispatch all pending axis bindings, then hold any more back until axisWindow has passed."""
+        self.axisTimer = None
+
+        if self.pendingAxes == {}: # If nothing happened during the window
+            return
+
+        pending = self.pendingAxes
+        self.pendingAxes = {}
+        lead = self if self.group == None else self.group.lead # In a group the lead owns the layer (and layer stack) bindings act on, like for keys
+
+        for binding, (delta, count, value, eventTime) in pending.items(): # Fire every binding once with what accumulated
+            lead.processKeycode(binding, {"delta": str(delta), "count": str(count), "value": str(value)}, eventTime)
+
+        self.axisTimer = scheduler.schedule(settings["axisWindow"], self.dispatchAxes) # Start a new dispatch window
+
+    def readEvents(self):
+        """Read all queued events in bulk and return them as a list of raw (sec, usec, type, code, value) tuples. Raise BlockingIOError if none are queued."""
+        events = []
+
+        while True: # Until we've emptied the queue
+            try: # Try to...
+                size = os.readv(self.device.fd, [self.readBuffer, ]) # Read as many events as fit in our buffer
+            except BlockingIOError: # If no (more) events are queued
+                if events == []:
+                    raise
+                break
+
+            events += inputEvent.iter_unpack(self.readView[:size]) # Decode the events straight out of the buffer
+
+            if size < len(self.readBuffer): # If the buffer wasn't filled there are no more events
+                break
+
+        if self.masked == False: # If the kernel didn't drop the events we don't use
+            events = [event for event in events if event[2] in self.eventTypes] # Do so ourselves
+
+        return events
+
+    def forwardEvents(self, events):
+        """Re-emit the events of unbound and remapped keys through the virtual keyboard in one batch, return the remaining events."""
+        boundKeys = getLayerIndex(self.currentLayer, "boundKeys")
+        remaps = getLayerIndex(self.currentLayer, "remaps")
+
+        ledgerEvents = [] # Events our ledger should see
+        keyEvents = [] # (code, value) events to emit
+
+        for event in events:
+            eventType, code, value = event[2:]
+            targets = None # The key codes to emit for this event, None if it isn't forwarded
+
+            if eventType == ecodes.EV_KEY:
+                if code in self.forwardedKeys: # If we are already forwarding the key
+                    targets = self.forwardedKeys[code]
+                    if value == keyUp: # If it was released we are done with it
+                        self.forwardedKeys.pop(code)
+
+                elif not value == keyUp: # If the key was pressed
+                    keyName = keyNames.get(code, "?")
+                    if keyName in remaps: # If the key is remapped
+                        targets = remaps[keyName]
+                    elif not keyName in boundKeys: # If no binding uses the key
+                        targets = [code, ]
+
+                    if not targets == None:
+                        self.forwardedKeys[code] = targets # Remember what we are forwarding it as
+
+            if targets == None: # If the event isn't forwarded
+                ledgerEvents += [event, ]
+            elif value == keyUp: # Release remapped chords in reverse
+                keyEvents += [(target, value) for target in reversed(targets)]
+            else:
+                keyEvents += [(target, value) for target in targets]
+
+        emitKeys(keyEvents)
+        return ledgerEvents
+
     def ungrabDevice(self):
         """Ungrab the device."""
-        qprint("ungrabbing device " + self.name)
+        qprint("ungrabbing device {}", self.name)
+        self.stopRepeat() # Don't keep repeating while we don't have the device
+        scheduler.cancel(self.axisTimer) # Or dispatching axes
+        for policy in self.policies.values(): # Or firing collapsed triggers
+            scheduler.cancel(policy["timer"])
+        self.policies = {}
+        self.axisTimer = None
+        self.pendingAxes = {}
         self.device.ungrab() # Do the thing that got said twice
 
     def close(self):
         """Try to close the device file gracefully."""
-        qprint("closing device " + self.name)
+        qprint("closing device {}", self.name)
 
         self.device.close() # Close the device
 
     def read(self, process=True):
         """Read all queued events (if any), update the ledger, and process the keycodes (or don't)."""
-        flushedHistories = False # A bool to store if we flushed any histories this update
+        return self.updateLedger(self.collectEvents(process), process)
+
+    def collectEvents(self, process=True):
+        """Read all queued events (if any) and return the ones left for a ledger after debouncing, passthrough and axis bindings."""
         try: # Try to...
-            flushedHistories = self.ledger.update(self.device.read()) # Update our ledger with any available events
+            events = self.readEvents() # Read all available events
+            self.eventCount += len(events) # Count them
+            stateBlock.changed = True # Our held keys may have changed
 
         except BlockingIOError: # If no events are available
-            flushedHistories = self.ledger.update((None, )) # Update our ledger so things get flushed if need be
+            events = []
+
+        if not self.debouncer == None: # If our switches chatter
+            events = self.debouncer.filter(events) # Drop bounces before anything else sees them
+
+        if self.passthrough == True: # If we re-emit unbound keys
+            events = self.forwardEvents(events) # Do so and keep the rest for our ledger
+        if process == True: # If we are processing
+            events = self.accumulateAxes(events) # Take axis events out for axis bindings
 
-        if process == True and flushedHistories == True: # If we are processing the ledger
-            self.processLedger() # Process the newly updated ledger
+        return events
+
+    def updateLedger(self, events, process=True):
+        """Update our ledger with events, and process the keycodes (or don't)."""
+        self.ledger.onRise = self.fireImmediate if process == True else None # Only fire bindings on press if we are processing
+
+        if not self.momentary == []: # If keys are holding momentary layers
+            events = self.filterMomentary(events) # Keep them out of our ledger
+
+        if events == []: # If no events are left for the ledger
+            events = (None, ) # Update our ledger anyway so things get flushed if need be
+
+        flushedHistories = self.ledger.update(events) # Update our ledger
+
+        if process == True: # If we are processing the ledger
+            self.checkRepeat() # Start or stop repeat bindings
+
+            if flushedHistories == True: # If we flushed a history
+                self.processLedger() # Process the newly updated ledger
+
+            self.releaseMomentary() # Leave momentary layers whose keys were released
 
         return flushedHistories # Return whether we flushed any histories
 
-    def setLeds(self):
-        """Set device leds bassed on current layer."""
-        if "leds" in readJson(self.currentLayer): # If the current layer specifies LEDs
-            if 17 in self.device.capabilities().keys(): # Check if the device had LEDs
-                leds = self.device.capabilities()[17] # Get a list of LEDs the device has
+    def fireImmediate(self, peak):
+        """Process a peak as soon as it's pressed if it can't lead to another binding, return True if we did."""
+        if not peak in getLayerIndex(self.currentLayer, "immediate"): # If the peak has to wait for its release and the flush timeout
+            return False
 
-                onLeds = readJson(self.currentLayer)["leds"] # Get a list of LEDs to turn on
-                dprint(f"device {self.name} setting leds {onLeds} on")
+        dprint("{}) firing {} on press", self.name, peak)
+        self.processKeycode(peak)
+        return True
 
-                for led in leds: # For all LEDs on the board
-                    if led in onLeds: # If the LED is to be set on
-                        self.device.set_led(led, 1) # Set it on
-                    else:
-                        self.device.set_led(led, 0) # Set it off
+    def checkRepeat(self):
+        """Start, continue or stop firing a repeat binding based on the keys currently held."""
+        peak = "" # The down keys str of a peak at the start of a history
+        if self.ledger.peaking == True and self.ledger.history == "": # Repeat bindings only match the first peak of a history
+            peak = self.ledger.downKeysStr()
 
-            else:
-                dprint("Device has no LEDs")
+        if not peak == self.repeatPeak: # If the held keys changed
+            self.stopRepeat() # Stop any repeat in progress
 
-        else:
-            print(f"Layer {readJson(self.currentLayer)} has no leds property, writing empty")
-            writeJson(self.currentLayer, {"leds": []}) # Write an empty list for LEDs into the current layer
-            leds = self.device.capabilities()[17] # Get a list of LEDs the device has
+            binding = getLayerTable(self.currentLayer).get(peak)
+            if not peak == "" and isRepeatBinding(binding): # If the new keys are bound to a repeat binding
+                dprint("{}) holding repeat binding {}", self.name, peak)
+                self.repeatPeak = peak
+
+                if "repeatInterval" in binding or self.autorepeat == False: # If we time the repeats ourselves
+                    delay = binding.get("repeatDelay", self.ledger.holdThreshold)
+                    self.repeatTimer = scheduler.scheduleAt(self.ledger.stateChangeStamp + delay, self.fireRepeat) # Fire once the keys have been held long enough
+
+        elif not self.repeatPeak == "" and self.repeatTimer == None: # If we are following kernel autorepeat
+            while self.repeatCount < self.ledger.autorepeats: # Fire once for every autorepeat event we haven't handled
+                self.fireRepeat()
+
+    def fireRepeat(self):
+        """Fire the current repeat binding and schedule the next repeat if we time them ourselves."""
+        self.ledger.suppressPeak = True # Don't fire the binding again on release
+        self.repeatCount += 1
+
+        self.processKeycode(self.repeatPeak)
+
+        if not self.repeatTimer == None: # If we time the repeats ourselves
+            interval = getLayerTable(self.currentLayer).get(self.repeatPeak, {}).get("repeatInterval", defaultRepeatInterval)
+            self.repeatTimer = scheduler.schedule(interval, self.fireRepeat) # Schedule the next one
 
-            for led in leds: # For all LEDs on the board
-                self.device.set_led(led, 0) # Set it off
+    def stopRepeat(self):
+        """Stop firing the current repeat binding."""
+        scheduler.cancel(self.repeatTimer)
+
+        self.repeatPeak = ""
+        self.repeatTimer = None
+        self.repeatCount = 0
+
+    def setLeds(self):
+        """Set device leds bassed on current layer, writing only the LEDs that changed in a single batch."""
+        onLeds = getLayerTable(self.currentLayer).get("leds", []) # Get a list of LEDs to turn on, layers without a leds property turn all LEDs off
+
+        changedLeds = [led for led in self.ledCodes if (led in onLeds) != (led in self.ledsOn)] # Find LEDs that are in the wrong state
+        if changedLeds == []: # If nothing changed
+            return
+
+        dprint("device {} setting leds {} on, changing {}", self.name, onLeds, changedLeds)
+
+        batch = b"" # Build all LED events and a single SYN_REPORT
+        for led in changedLeds:
+            batch += inputEvent.pack(0, 0, ecodes.EV_LED, led, int(led in onLeds))
+        batch += inputEvent.pack(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+
+        os.write(self.device.fd, batch) # And write them at once
+        self.ledsOn = {led for led in self.ledCodes if led in onLeds} # Remember which LEDs are on
 
     def processLedger(self):
         """Process any flushed histories from our ledger."""
@@ -352,66 +914,280 @@ class macroDevice():
             self.processKeycode(keycode) # Process it
             keycode = self.ledger.popHistory() # And grab the next one (blank if none are available)
         
-    def processKeycode(self, keycode):
-        """Parse a command in our current layer bound to the passed keycode (ledger history)."""
-        dprint(f"{self.name} is processing {keycode} in layer {self.currentLayer}") # Print debug info
+    def processKeycode(self, keycode, eventVars = None, eventTime = None):
+        """Parse a command in our current layer bound to the passed keycode (ledger history or axis binding), with an optional dict of extra vars and the timestamp of the event that triggered it."""
+        dprint("{} is processing {} in layer {}", self.name, keycode, self.currentLayer) # Log debug info
+
+        layerTable = getLayerTable(self.currentLayer) # Get the flattened current layer
+
+        self.lastHistory = keycode # Publish what we processed
+        stateBlock.changed = True
+
+        if eventTime == None: # Key bindings were triggered by the last key event the ledger saw
+            eventTime = self.ledger.eventStamp
+
+        if keycode in layerTable: # If the keycode is bound in our current layer or one of its parents
+            binding = layerTable[keycode] # Get the binding
+
+            if hasPolicy(binding): # If the binding limits how often it fires
+                self.applyPolicy(keycode, binding, eventVars, eventTime) # Let its policy decide when to run it
+            else:
+                self.runBinding(keycode, binding, eventVars, self.currentLayer, eventTime) # Run it
+
+    def applyPolicy(self, keycode, binding, eventVars, eventTime):
+        """Count a trigger of a binding with a policy and run it now, later (collapsed with other triggers) or not at all."""
+        layer = self.currentLayer
+        policy = self.policies.setdefault((layer, keycode), {"last": 0, "count": 0, "timer": None}) # Get the state of the binding's policy
+        policy["eventTime"] = eventTime # Collapsed triggers report the time of the last one
+
+        if not eventVars == None and "count" in eventVars: # Axis bindings arrive with a count already
+            policy["count"] += int(eventVars["count"])
+        else:
+            policy["count"] += 1
+
+        if "debounce" in binding: # If the binding should fire once triggers stop for a while
+            scheduler.cancel(policy["timer"]) # Restart the wait
+            policy["timer"] = scheduler.schedule(binding["debounce"], self.firePolicy, keycode, binding, eventVars, layer)
+
+        elif "collapse" in binding: # If the binding should fire once for all triggers within a window
+            if policy["timer"] == None: # If this trigger starts a window
+                policy["timer"] = scheduler.schedule(binding["collapse"], self.firePolicy, keycode, binding, eventVars, layer)
+
+        else: # Otherwise fire right away (if the other limits allow)
+            self.firePolicy(keycode, binding, eventVars, layer)
+
+    def firePolicy(self, keycode, binding, eventVars, layer):
+        """Run a binding with a policy unless its minInterval or maxInFlight limits say not to, passing the number of collapsed triggers as %count%."""
+        policy = self.policies[(layer, keycode)]
+        count = policy["count"]
+
+        policy["timer"] = None
+        policy["count"] = 0
+
+        if time.time() - policy["last"] < binding.get("minInterval", 0): # If the binding fired too recently
+            dprint("{}) dropping {} trigger(s) of {}, minInterval not reached", self.name, count, keycode)
+            return
+
+        if "maxInFlight" in binding and countRunning((self.name, layer, keycode)) >= binding["maxInFlight"]: # If too many of its commands are still running
+            dprint("{}) dropping {} trigger(s) of {}, {} still running", self.name, count, keycode, binding['maxInFlight'])
+            return
+
+        policy["last"] = time.time()
+        self.runBinding(keycode, binding, {**(eventVars or {}), "count": str(count)}, layer, policy["eventTime"])
 
-        if keycode in readJson(self.currentLayer): # If the keycode is in our current layer's json file
-            value = readJson(self.currentLayer)[keycode] # Get the instructions associated with the keycode
-            value = parseVars(value, self.currentLayer) # Parse any varables that may appear in the command
+    def runBinding(self, keycode, binding, eventVars, layer, eventTime = None):
+        """Run a binding resolved in layer, triggered by an event at eventTime."""
+        self.dispatchCount += 1
 
-            if value.startswith("layer:"): # If value is a layerswitch command
-                if os.path.exists(layerDir+value.split(':')[-1] + ".json") == False: # If the layer has no json file
-                    createLayer(value.split(':')[-1]+".json") # Create one
-                    print("Created layer file: " + value.split(':')[-1]+".json") # Notify the user
-                    self.currentLayer = value.split(':')[-1] + ".json" # Switch to our new layer file
-                    print("Switched to layer file: " + value.split(':')[-1] + ".json") # Notify the user
+        argv = bindingArgv(binding)
+        if not argv == None: # If the binding runs a program without a shell
+            self.runArgv(keycode, argv, eventVars, layer, eventTime)
+            return
 
+        value = bindingCommand(binding) # Get the instructions associated with the keycode
+        value = parseVars(value, layer, eventVars) # Parse any varables that may appear in the command
+        previousLayer = self.currentLayer
+
+        if value.startswith("layer:"): # If value is a layerswitch command
+            self.switchLayer(layerFilename(value.split(":", 1)[1])) # Replace our current layer
+
+        elif value.startswith("layer-push:"): # If value switches to a layer we can pop back from
+            if self.switchLayer(layerFilename(value.split(":", 1)[1])) == True:
+                self.layerStack.append(previousLayer) # Remember where we came from
+
+        elif value.startswith("layer-pop:"): # If value switches back to the layer we pushed from
+            if not self.layerStack == []:
+                self.switchLayer(self.layerStack.pop())
+
+        elif value.startswith("layer-hold:"): # If value switches to a layer while its keys are held
+            keys = keycode.split("+")
+            if self.switchLayer(layerFilename(value.split(":", 1)[1])) == True:
+                self.layerStack.append(previousLayer)
+
+                if all([key in self.ledger.downKeys for key in keys]): # If the keys are still held (the binding fired on press)
+                    self.momentary.append([{ecodes.ecodes[key] for key in keys}, len(self.layerStack) - 1, False]) # Switch back when they are released
+                    self.ledger.downKeys = [key for key in self.ledger.downKeys if not key in keys] # Keys pressed while holding them form peaks of their own
                 else:
-                    self.currentLayer = value.split(':')[-1] + ".json" # Set self.current layer to the target layer
-                    print("Switched to layer file: " + value.split(':')[-1] + ".json") # Notify the user
+                    dprint("{}) {} fired after release, not momentary", self.name, keycode)
 
-                self.setLeds() # Set LEDs based on the new current layer
+        elif value.startswith("keys:") or value.startswith("type:"): # If value is a keystroke macro
+            qprint("{}: {}", keycode, value) # Notify the user of the macro
+            playMacro(compileMacro(value)) # Start playing it through our virtual keyboard
 
-            elif value.strip() != "":
-                if value.strip().endswith("&") == False and settings["forceBackground"]: # If value is not set in run in the background and our settings say to force running in the background
-                    value += " &" # Force running in the background
-                    
-                if value.strip().endswith("&") == False and settings["backgroundInversion"]: # If value is not set to run in the background and our settings say to invert background mode
-                    value += " &" # Force running in the background
-                
-                elif value.strip().endswith("&") and settings["backgroundInversion"]: # Else if value is set to run in the background and our settings say to invert background mode
-                    value = value.rstrip(" &") # Remove all spaces and &s from the end of value, there might be a better way but this is the best I've got
-
-                scriptTypes = { # A dict of script types and thier interpreters with a trailing space
-                    "script": "bash ",
-                    "py": "python ",
-                    "py2": "python2 ",
-                    "py3": "python3 ",
-                    "exec": "",
-                }
-
-                for scriptType in scriptTypes.keys(): # For recognized script types
-                    if value.startswith(scriptType + ":"): # Check if value is one of said script types
-                        print(f"Executing {scriptTypes[scriptType]}script {value.split(':')[-1]}") # Notify the user we re running a script
-                        value = scriptTypes[scriptType] + scriptDir + value.split(':')[-1] # Set value to executable format
-                        break # Break the loop
-                
-                else: # If this is not a script (i.e. it is a shell command)
-                    print(keycode+": "+value) # Notify the user of the command
+        elif value.startswith("remap:"): # If value is a remap on a device without passthrough
+            playMacro(compileMacro("keys:" + value[len("remap:"):])) # Tap the keys it maps to
+
+        elif value.strip() != "":
+            if value.strip().endswith("&") == False and settings["forceBackground"]: # If value is not set in run in the background and our settings say to force running in the background
+                value += " &" # Force running in the background
                 
-                os.system(value) # Execute value
+            if value.strip().endswith("&") == False and settings["backgroundInversion"]: # If value is not set to run in the background and our settings say to invert background mode
+                value += " &" # Force running in the background
+            
+            elif value.strip().endswith("&") and settings["backgroundInversion"]: # Else if value is set to run in the background and our settings say to invert background mode
+                value = value.rstrip(" &") # Remove all spaces and &s from the end of value, there might be a better way but this is the best I've got
+
+            for scriptType in scriptTypes.keys(): # For recognized script types
+                if value.startswith(scriptType + ":"): # Check if value is one of said script types
+                    log(logNotice, "Executing {}script {}", scriptTypes[scriptType], value.split(':')[-1]) # Notify the user we re running a script
+                    value = scriptTypes[scriptType] + scriptDir + value.split(':')[-1] # Set value to executable format
+                    break # Break the loop
+            
+            else: # If this is not a script (i.e. it is a shell command)
+                log(logNotice, "{}: {}", keycode, value) # Notify the user of the command
+            
+            runCommand(value, (self.name, layer, keycode), self.commandEnvironment(keycode, layer, eventVars, eventTime)) # Execute value
+
+    def runArgv(self, keycode, argv, eventVars, layer, eventTime = None):
+        """Run a binding given as an argv list directly, without a shell. Each arg has its vars replaced on its own, so values never need quoting."""
+        argv = [parseVars(arg, layer, eventVars, None) for arg in argv]
+        if None in argv or argv == [] or argv == ["&", ]: # If a var had no value or there is nothing to run
+            return
+
+        background = argv[-1] == "&"
+        if background == True:
+            argv = argv[:-1]
+
+        if settings["forceBackground"] or settings["backgroundInversion"]: # Like shell commands, run in the background if forced or if inverted and not asked to
+            background = not background or settings["forceBackground"]
+
+        for scriptType in scriptTypes.keys(): # For recognized script types
+            if argv[0].startswith(scriptType + ":"): # Run the script with its interpreter, args are passed to the script
+                argv = scriptTypes[scriptType].split() + [scriptDir + argv[0].split(":")[-1], ] + argv[1:]
+                break
+
+        log(logNotice, "{}: {}", keycode, shlex.join(argv)) # Notify the user of the command
+        runCommand(argv + ["&", ] * background, (self.name, layer, keycode), self.commandEnvironment(keycode, layer, eventVars, eventTime)) # Execute it
+
+    def commandEnvironment(self, keycode, layer, eventVars, eventTime = None):
+        """Return the environment for a command run by a binding, with the context it ran in as KEEBIE_* variables."""
+        environment = {
+            **os.environ,
+            "KEEBIE_DEVICE": self.name,
+            "KEEBIE_LAYER": layer,
+            "KEEBIE_HISTORY": keycode,
+            "KEEBIE_EVENT_TIME": f"{self.ledger.eventStamp if eventTime == None else eventTime:.6f}", # Kernel timestamp of the event that triggered the binding
+            "KEEBIE_DISPATCH_TIME": f"{time.time():.6f}", # When the binding was dispatched
+        }
+
+        for name, value in (eventVars or {}).items(): # Vars given by axis bindings and binding policies
+            environment["KEEBIE_" + name.upper()] = value
+
+        return environment
+
+    def switchLayer(self, layer):
+        """Make a layer our current layer, return False if it doesn't exist. Layers bindings switch to were flattened when the device was grabbed, so this doesn't touch the disk."""
+        try: # Try to...
+            getLayerTable(layer) # Make sure the layer is loaded
+        except FileNotFoundError: # If it was removed since it was preloaded
+            log(logNotice, "Can't switch to missing layer file {}", layer)
+            return False
+
+        self.currentLayer = layer
+        log(logNotice, "Switched to layer file: {}", self.currentLayer) # Notify the user
+
+        self.setLeds() # Set LEDs based on the new current layer
+        self.updateEventMask() # And get the events it uses
+        self.resolveTiming() # And the ledger settings it wants
+        warmVars(self.currentLayer) # And start computing its dynamic vars
+
+        if not self.group == None: # If we lead a group
+            self.group.syncLayer() # Switch its other members too
+
+        return True
+
+    def filterMomentary(self, events):
+        """Take the events of keys holding momentary layers out of events, noting when they are released."""
+        otherEvents = []
+        for event in events:
+            if not event == None and event[2] == ecodes.EV_KEY:
+                for hold in self.momentary:
+                    if event[3] in hold[0]: # If the key holds a momentary layer
+                        if event[4] == keyUp:
+                            hold[2] = True # Note it was released
+                        break
+
+                else:
+                    otherEvents.append(event)
+
+            else:
+                otherEvents.append(event)
+
+        return otherEvents
+
+    def releaseMomentary(self):
+        """Switch back from momentary layers whose keys were released, once the keys pressed while holding them are done."""
+        while not self.momentary == [] and any([hold[2] for hold in self.momentary]):
+            if not self.ledger.downKeys == []: # If keys pressed in the momentary layer are still down
+                return
+
+            if not self.ledger.history == "": # If they formed a history
+                self.ledger.flushHistory() # Process it in the momentary layer right away
+                self.processLedger()
+
+            depth = min([hold[1] for hold in self.momentary if hold[2] == True]) # The lowest released layer, layers held above it go with it
+            self.momentary = [hold for hold in self.momentary if hold[1] < depth]
+
+            if depth < len(self.layerStack): # Unless something popped it already
+                layer = self.layerStack[depth]
+                del self.layerStack[depth:]
+                self.switchLayer(layer)
 
     def clearLedger(self):
         """Clear this devices ledger."""
         try: # Try to...
-            for event in self.device.read(): # For all queued events
-                pass # Completely ignore them
+            self.readEvents() # Read all queued events and completely ignore them
         
         except BlockingIOError: # If there arn't any queued events
             pass # Ignore that too
         
-        self.ledger = keyLedger(self.name) # Reset the ledger
+        if not self.group == None: # If our ledger is shared
+            self.group.resetLedger() # Reset it for the whole group
+        else:
+            self.ledger = keyLedger(self.name) # Reset the ledger
+            self.ledger.ignored_keys = self.ignoredKeys
+            self.resolveTiming()
+
+
+class deviceGroup():
+    """A class for devices that share a single ledger and layer, so keys on different devices (like a pedal and a pad) can form chords.
+
+    The group's lead (its first member by name) owns the ledger, the layer and all processing, the other members only feed it their events.
+    Member events are merged by kernel timestamp and applied by the single thread running the loop, so the shared state never sees concurrent updates."""
+    def __init__(self, name, members):
+        self.name = name # Name of the group for debugging
+        self.members = sorted(members, key=lambda member: member.name) # The member macroDevices
+        self.lead = self.members[0] # The member whose layer and processing the group uses
+
+        for member in self.members:
+            member.group = self
+            member.currentLayer = self.lead.currentLayer # All members start on the lead's layer
+
+        self.resetLedger()
+
+    def resetLedger(self):
+        """Give all members a new shared ledger."""
+        ledger = keyLedger(self.name)
+
+        for member in self.members:
+            ledger.ignored_keys += member.ignoredKeys # Ignore what any member ignores
+            member.ledger = ledger
+
+        self.lead.resolveTiming() # The lead's device and layer decide the shared ledger's settings
+
+    def read(self, process=True):
+        """Read the events of all members, merge them in the order they happened, and update the shared ledger with them."""
+        streams = [member.collectEvents(process) for member in self.members] # Each member's events are in order already
+        events = list(heapq.merge(*streams, key=lambda event: (event[0], event[1]))) # So merging them only compares the heads of each stream
+
+        return self.lead.updateLedger(events, process)
+
+    def syncLayer(self):
+        """Switch all members to the lead's layer."""
+        for member in self.members[1:]:
+            member.currentLayer = self.lead.currentLayer
+            member.setLeds()
+            member.updateEventMask()
 
 
 macroDeviceList = [] # List of macroDevice instances
@@ -432,7 +1208,7 @@ def setupMacroDevices():
 
     for device in macroDeviceList: # For all preexisting devices
         if not device.name + ".json" in deviceJsonList: # If a preexisting device is not in our list of devices
-            dprint(f"Device {device.name} has been removed")
+            dprint("Device {} has been removed", device.name)
             macroDeviceList.remove(device) # Delete it (It should already be closed)
 
     dprint([device.name for device in macroDeviceList])
@@ -441,15 +1217,20 @@ def setupMacroDevices():
     for deviceJson in deviceJsonList: # For all json files in deviceDir
         for device in macroDeviceList: # For all preexisting devices
             if deviceJson == device.name + ".json": # If the new device is already known
-                dprint(f"Device {device.name} already known")
+                dprint("Device {} already known", device.name)
                 break
 
         else: # If the loop was never broken
-            dprint("New device " + deviceJson)
+            dprint("New device {}", deviceJson)
             newMacroDeviceList += [macroDevice(deviceJson), ] # Set up a macroDevice instance for all files and save them to newMacroDeviceList
 
+    if not workerShard == None: # If we are a worker only set up the devices of our shard
+        newMacroDeviceList = [device for device in newMacroDeviceList if deviceShard(device) == workerShard]
+
     macroDeviceList += newMacroDeviceList # Add the list ofnew devices to the list of preexisting ones
 
+    setupDeviceGroups() # Group devices that share a ledger
+
 def grabMacroDevices():
     """Grab all devices with macroDevices."""
     global devicesAreGrabbed # Globallize devicesAreGrabbed
@@ -471,18 +1252,24 @@ def closeDevices():
     for device in macroDeviceList:
         device.close()
 
-def mergeDeviceLedgers():
-    """Merge the key ledgers of all macroDevices into one and return it."""
-    returnLedger = keyLedger() # Create an empty key ledger
-    
-    for device in macroDeviceList: # For all macroDevices
-        returnLedger.newKeys += device.ledger.newKeys # Add the devices key lists to the return ledger
-        returnLedger.lostKeys += device.ledger.lostKeys
-        returnLedger.downKeys += device.ledger.downKeys
+deviceGroups = [] # List of deviceGroup instances
+
+def setupDeviceGroups():
+    """Set up a deviceGroup for every group named by more than one macroDevice."""
+    global deviceGroups # Globalize deviceGroups
+
+    groupMembers = {} # A dict of lists of devices by group name
+    for device in macroDeviceList:
+        device.group = None
 
-        returnLedger.histories += device.ledger.histories # Add the devices histories to the return ledger
+        if not device.groupName == None:
+            groupMembers.setdefault(device.groupName, []).append(device)
 
-    return returnLedger # Return the ledger we built
+    deviceGroups = []
+    for groupName, members in groupMembers.items():
+        if len(members) > 1: # A group of one is just a device
+            dprint("Device group {} has members {}", groupName, [member.name for member in members])
+            deviceGroups += [deviceGroup(groupName, members), ]
 
 def clearDeviceLedgers():
     """Clear all device ledgers."""
@@ -493,9 +1280,13 @@ def readDevices(process=True):
     """Read and optionally process all devices events."""
     flushedHistories = False # A bool to store if we flushed any histories this update
     for device in macroDeviceList: # For all macroDevices
-        if device.read(process) == True: # If any of our devices flush any histories
+        if device.group == None and device.read(process) == True: # If any of our devices not in a group flush any histories
             flushedHistories = True # Store that
 
+    for group in deviceGroups: # For all device groups
+        if group.read(process) == True: # If any of them flush any histories
+            flushedHistories = True
+
     return flushedHistories # Return whether we flushed any histories
 
 def popDeviceHistories():
@@ -554,58 +1345,620 @@ def popJson(filename, key, dir = layerDir): # Removes the key key and it's value
 
 # Layer file
 
+layerMetaKeys = ("leds", "vars", "extends", "immediate") + ledgerSettings # Top level keys of a layer file that are not key bindings
+
+layerTables = {} # A dict of flattened layers (a layer with all of its parents merged in) keyed by layer filename
+layerIndexes = {} # A dict of lookup indexes precomputed from each flattened layer, keyed by layer filename
+layerTableFiles = {} # A dict of the layer files (and their modification times) each flattened layer was built from
+staleLayers = {} # A dict of (table, files, indexes) of flattened layers dropped because their files changed, used if the new files can't be read
+layerCheckInterval = 1 # How many seconds to wait between checking flattened layers for changed files
+lastLayerCheck = 0 # The timestamp of the last check
+layerCachePath = dataDir + "layers.cache" # A path where --check saves flattened layers and their indexes for the loop to load at startup
+layerCacheVersion = 1 # The version of the layer cache format, bump it when the flattened layers or their indexes change layout
+
 def createLayer(filename): # Creates a new layer with a given filename
     shutil.copyfile(installDataDir + "/data/layers/default.json", layerDir + filename) # Copy the provided default layer file from installedDataDir to specified filename
 
+def layerParents(layerData): # Return a list of parent layer filenames of a layer dict, in descending priority
+    parents = layerData.get("extends", [])
 
+    if type(parents) == str: # A single parent may be given without a list
+        parents = [parents, ]
 
-# Settings file
+    return [layerFilename(parent) for parent in parents]
 
-settings = { # A dict of settings to be used across the script
-    "multiKeyMode": "combination",
-    "forceBackground": False,
-    "backgroundInversion": False,
-	"loopDelay": 0.0167,
-    "holdThreshold": 1,
-    "flushTimeout": 0.5,
-}
+def flattenLayer(layer, chain = ()):
+    """Return a dict of layer's contents with its parents merged in, and a dict of the files used and their modification times."""
+    layerData = readJson(layer)
+    files = {layer: os.path.getmtime(layerDir + layer)} # Remember every file we read so changes can be detected
+    flatData = {"vars": {}}
 
-settingsPossible = { # A dict of lists of valid values for each setting (or if first element is type then list of acceptable types in descending priority)
-    "multiKeyMode": ["combination", "sequence"],
-    "forceBackground": [True, False],
-    "backgroundInversion": [True, False],
-	"loopDelay": [type, float, int],
-    "holdThreshold": [type, float, int],
-    "flushTimeout": [type, float, int],
-}
+    for parent in reversed(layerParents(layerData)): # For all parents, lowest priority first so higher priority ones override them
+        if parent in chain + (layer, ): # If the parent is also a descendant
+            log(logNotice, "Layer {} extends {} which extends it, ignoring", layer, parent)
+            continue
 
-def getSettings(): # Reads the json file specified on the third line of config and sets the values of settings based on it's contents
-    dprint(f"Loading settings from {dataDir}/settings.json") # Notify the user we are getting settings and tell them the file we are using to do so
+        try: # Try to...
+            parentData, parentFiles = flattenLayer(parent, chain + (layer, )) # Flatten the parent
+        except FileNotFoundError: # If the parent doesn't exist
+            log(logNotice, "Layer {} extends missing layer {}, ignoring", layer, parent)
+            continue
 
-    settingsFile = readJson("settings.json", dataDir) # Get a dict of the keys and values in our settings file
-    for setting in settings.keys(): # For every setting we expect to be in our settings file
-        if type == settingsPossible[setting][0]: # If first element is type
-            if type(settingsFile[setting]) in settingsPossible[setting]: # If the value in our settings file is valid
-                dprint(f"Found valid typed value: \"{type(settingsFile[setting])}\" for setting: \"{setting}\"")
-                settings[setting] = settingsFile[setting] # Write it into our settings
-            else :
-                print(f"Value: \"{settingsFile[setting]}\" for setting: \"{setting}\" is of invalid type, defaulting to {settings[setting]}") # Warn the user of invalid settings in the settings file
+        flatData.update({key: value for key, value in parentData.items() if not key == "vars"}) # Inherit the parent's bindings and LEDs
+        flatData["vars"].update(parentData["vars"]) # And merge in its vars
+        files.update(parentFiles)
+
+    flatData.update({key: value for key, value in layerData.items() if not key in ("vars", "extends")}) # Our own bindings and LEDs win over inherited ones
+    flatData["vars"].update(layerData.get("vars", {})) # As do our own vars
+
+    return flatData, files
+
+def indexLayer(layerTable, layer = "layer"):
+    """Return a dict of lookup indexes for a flattened layer (named layer in warnings)."""
+    firstPeaks = [] # A list of (binding, set of keys in its first peak) for all key bindings
+    axes = set() # Axis bindings
+    eventTypes = {ecodes.EV_KEY, } # The event types the layer uses
+    for binding in layerTable.keys():
+        if binding in layerMetaKeys:
+            continue
+
+        if isAxisBinding(binding):
+            axes.add(binding)
+            eventTypes.add(ecodes.EV_REL if binding.startswith("REL_") else ecodes.EV_ABS)
         else:
-            if settingsFile[setting] in settingsPossible[setting]: # If the value in our settings file is valid
-                dprint(f"Found valid value: \"{settingsFile[setting]}\" for setting: \"{setting}\"")
-                settings[setting] = settingsFile[setting] # Write it into our settings
-            else :
-                print(f"Value: \"{settingsFile[setting]}\" for setting: \"{setting}\" is invalid, defaulting to {settings[setting]}") # Warn the user of invalid settings in the settings file
+            firstPeaks += [(binding, set(binding.split("-")[0].split("+")) - {"HELD", }), ]
 
-    dprint(f"Settings are {settings}") # Debug info
+    immediate = set() # Bindings that may fire as soon as their keys are pressed
+    for binding, keys in firstPeaks:
+        if "-" in binding or binding.endswith("+HELD"): # Only single peaks that aren't held can fire on press
+            continue
 
+        options = layerTable[binding] if type(layerTable[binding]) == dict else {}
+        if options.get("immediate", layerTable.get("immediate", False)) == False and not bindingCommand(layerTable[binding]).startswith("layer-hold:"): # If neither the binding nor the layer asks to fire on press (momentary layers always do)
+            continue
 
+        for other, otherKeys in firstPeaks: # Check if pressing more keys or waiting could lead to another binding
+            if not other == binding and otherKeys >= keys: # If another binding starts with (a superset of) our keys
+                dprint("{} can't fire on press, it is a prefix of {}", binding, other)
+                break
 
-# Keypress processing
+        else: # If nothing else starts with our keys
+            immediate.add(binding)
 
-def parseVars(commandStr, layer): # Given a command from the layer json file replace vars with their values and return the string
-    # Vars we will need in the loop
-    returnStr = "" # The string to be retuned
+    boundKeys = set() # Names of keys used by bindings, passthrough devices forward all other keys
+    remaps = {} # A dict of key names remapped by "remap:" bindings and the key codes they are remapped to
+    for binding, keys in firstPeaks:
+        command = bindingCommand(layerTable[binding])
+
+        if command.startswith("remap:") and not "-" in binding and not "+" in binding: # If a single key is remapped
+            remaps[binding] = [ecodes.ecodes[keyName] for keyName in command[len("remap:"):].split("+") if keyName in ecodes.ecodes]
+        else:
+            boundKeys.update(binding.replace("-", "+").split("+"))
+
+    timing = validTiming(layerTable, f"layer {layer}") # Ledger settings the layer overrides
+
+    return {"immediate": immediate, "boundKeys": boundKeys, "remaps": remaps, "axes": axes, "eventTypes": eventTypes, "timing": timing}
+
+def getLayerTable(layer):
+    """Return the flattened lookup table for a layer, building it (and its indexes) if it isn't cached."""
+    if not layer in layerTables: # If we haven't flattened this layer yet
+        try: # Try to...
+            layerTables[layer], layerTableFiles[layer] = flattenLayer(layer) # Do so
+            layerIndexes[layer] = indexLayer(layerTables[layer], layer) # And precompute our lookup indexes
+            dprint("Flattened layer {} from {}", layer, list(layerTableFiles[layer].keys()))
+
+        except ValueError as error: # If a file is invalid JSON (like while it is being edited)
+            table, files, index = staleLayers.get(layer, ({"vars": {}}, {layer: 0}, None)) # Keep the previous version, or use an empty layer
+            log(logNotice, "Can't read layer {} ({}), {} until its files change", layer, error, "keeping its previous version" if layer in staleLayers else "using an empty layer")
+
+            layerTables[layer], layerIndexes[layer] = table, index or indexLayer(table, layer)
+            layerTableFiles[layer] = {filename: os.path.getmtime(layerDir + filename) for filename in files if os.path.exists(layerDir + filename)} # Don't retry until they change again
+
+        staleLayers.pop(layer, None)
+
+    return layerTables[layer]
+
+def getLayerIndex(layer, index):
+    """Return a precomputed lookup index of a flattened layer."""
+    getLayerTable(layer) # Make sure the layer has been flattened
+
+    return layerIndexes[layer][index]
+
+def checkLayerTables(force = False):
+    """Drop any flattened layers built from layer files that have changed, at most once every layerCheckInterval unless forced."""
+    global lastLayerCheck
+
+    if force == False and time.time() - lastLayerCheck < layerCheckInterval: # If we checked recently
+        return
+
+    lastLayerCheck = time.time()
+    dropped = force # Whether devices need to resolve their ledger settings again
+
+    for layer, files in list(layerTableFiles.items()): # For all flattened layers
+        for filename, mtime in files.items(): # For all the files they were built from
+            try: # Try to...
+                changed = not os.path.getmtime(layerDir + filename) == mtime # Check if the file was modified
+            except FileNotFoundError: # If the file was removed
+                changed = True
+
+            if changed == True: # If it was drop the flattened layer so it will be rebuilt on next use
+                dprint("Layer file {} changed, dropping flattened layer {}", filename, layer)
+                staleLayers[layer] = (layerTables.pop(layer), layerTableFiles.pop(layer), layerIndexes.pop(layer))
+                dropped = True
+                break
+
+    if dropped == True: # If any layer may have changed
+        for device in macroDeviceList: # Resolve every device's ledger settings again
+            if device.group == None or device.group.lead == device: # (only the lead's count in a group)
+                preloadLayers(device.initialLayer) # Loading any layers they may now switch to
+                preloadLayers(device.currentLayer)
+                device.resolveTiming()
+
+layerSwitchCommands = ("layer:", "layer-push:", "layer-hold:") # Prefixes of bindings that switch to another layer
+
+def preloadLayers(layer):
+    """Flatten a layer and every layer its bindings can switch to (and so on), creating missing ones, so switching layers never touches the disk."""
+    pending = [layerFilename(layer), ]
+    seen = set()
+
+    while not pending == []:
+        layer = pending.pop()
+        if layer in seen:
+            continue
+        seen.add(layer)
+
+        if not layer in layerTables and os.path.exists(layerDir + layer) == False: # If the layer has no json file
+            createLayer(layer) # Create one
+            log(logNotice, "Created layer file: {}", layer) # Notify the user
+
+        for binding in getLayerTable(layer).values(): # For every binding of the layer
+            command = bindingCommand(binding) if type(binding) in (str, dict) else ""
+            if command.startswith(layerSwitchCommands) and not "%" in command: # If it switches to a (fixed) layer
+                pending.append(layerFilename(command.split(":", 1)[1]))
+
+def layerFilename(layer): # Return the filename of a layer given with or without its .json extension
+    if layer.endswith(".json"):
+        return layer
+
+    return layer + ".json"
+
+def isAxisBinding(binding): # Return True if a binding is for a relative or absolute axis (like REL_DIAL+, REL_WHEEL or ABS_X) rather than keys
+    return binding.startswith("REL_") or binding.startswith("ABS_")
+
+def validateKeycode(keycode):
+    """Return a list of problems with a ledger history str or axis binding (empty if it is valid)."""
+    problems = []
+
+    if keycode.strip() == "": # If the history is blank
+        return ["empty key"]
+
+    if isAxisBinding(keycode): # If the binding is for an axis
+        if keycode.startswith("ABS_") and keycode.endswith(("+", "-")): # Absolute axes don't have directions
+            return [f"absolute axis {keycode} can't have a direction"]
+
+        if not keycode.rstrip("+-") in ecodes.ecodes: # If evdev doesn't know the axis name
+            return [f"unknown axis name {keycode.rstrip('+-')}"]
+
+        return []
+
+    for peak in keycode.split("-"): # For every key peak in the history
+        for key in peak.split("+"): # For every key in the peak
+            if key == "HELD": # Held markers are added by the ledger, not evdev
+                continue
+
+            if not key in ecodes.ecodes: # If evdev doesn't know the key name
+                problems += [f"unknown key name {key}", ]
+
+    return problems
+
+
+
+# Settings file
+
+settings = { # A dict of settings to be used across the script
+    "multiKeyMode": "combination",
+    "forceBackground": False,
+    "backgroundInversion": False,
+	"loopDelay": 0.0167,
+    "holdThreshold": 1,
+    "flushTimeout": 0.5,
+    "keyDelay": 0.01,
+    "axisWindow": 0.05,
+    "realtimePriority": 0,
+    "niceLevel": 0,
+    "cpuAffinity": -1,
+    "lockMemory": False,
+    "shardDevices": False,
+    "journalFile": False,
+}
+
+settingsPossible = { # A dict of lists of valid values for each setting (or if first element is type then list of acceptable types in descending priority)
+    "multiKeyMode": ["combination", "sequence"],
+    "forceBackground": [True, False],
+    "backgroundInversion": [True, False],
+	"loopDelay": [type, float, int],
+    "holdThreshold": [type, float, int],
+    "flushTimeout": [type, float, int],
+    "keyDelay": [type, float, int],
+    "axisWindow": [type, float, int],
+    "realtimePriority": [type, int],
+    "niceLevel": [type, int],
+    "cpuAffinity": [type, int],
+    "lockMemory": [True, False],
+    "shardDevices": [True, False],
+    "journalFile": [True, False],
+}
+
+def validTiming(jsonData, source):
+    """Return a dict of the valid ledger settings in a device or layer dict, warning about invalid ones."""
+    timing = {}
+    for setting in ledgerSettings: # For all settings a ledger uses
+        if not setting in jsonData: # If it isn't overridden
+            continue
+
+        value = jsonData[setting]
+        if type == settingsPossible[setting][0]: # If first element is type
+            valid = type(value) in settingsPossible[setting]
+        else:
+            valid = value in settingsPossible[setting]
+
+        if valid == True:
+            timing[setting] = value
+        else:
+            log(logNotice, "Value: \"{}\" for setting: \"{}\" in {} is invalid, ignoring it", value, setting, source) # Warn the user
+
+    return timing
+
+def getSettings(): # Reads the json file specified on the third line of config and sets the values of settings based on it's contents
+    dprint("Loading settings from {}/settings.json", dataDir) # Notify the user we are getting settings and tell them the file we are using to do so
+
+    settingsFile = readJson("settings.json", dataDir) # Get a dict of the keys and values in our settings file
+    for setting in settings.keys(): # For every setting we expect to be in our settings file
+        if not setting in settingsFile: # If the settings file predates the setting
+            dprint("Setting \"{}\" not in settings file, defaulting to {}", setting, settings[setting])
+            continue
+
+        if type == settingsPossible[setting][0]: # If first element is type
+            if type(settingsFile[setting]) in settingsPossible[setting]: # If the value in our settings file is valid
+                dprint("Found valid typed value: \"{}\" for setting: \"{}\"", type(settingsFile[setting]), setting)
+                settings[setting] = settingsFile[setting] # Write it into our settings
+            else :
+                log(logNotice, "Value: \"{}\" for setting: \"{}\" is of invalid type, defaulting to {}", settingsFile[setting], setting, settings[setting]) # Warn the user of invalid settings in the settings file
+        else:
+            if settingsFile[setting] in settingsPossible[setting]: # If the value in our settings file is valid
+                dprint("Found valid value: \"{}\" for setting: \"{}\"", settingsFile[setting], setting)
+                settings[setting] = settingsFile[setting] # Write it into our settings
+            else :
+                log(logNotice, "Value: \"{}\" for setting: \"{}\" is invalid, defaulting to {}", settingsFile[setting], setting, settings[setting]) # Warn the user of invalid settings in the settings file
+
+    macroCache.clear() # Macros are compiled with the old keyDelay
+
+    dprint("Settings are {}", dict(settings)) # Debug info
+
+
+
+# Virtual keyboard
+
+virtualKeyboard = None # A UInput device we emit keystrokes through, created on first use
+
+typeableChars = { # A dict of chars and the (shifted, key name) needed to type them on a US layout
+    " ": (False, "KEY_SPACE"), "\n": (False, "KEY_ENTER"), "\t": (False, "KEY_TAB"),
+    "-": (False, "KEY_MINUS"), "=": (False, "KEY_EQUAL"), "[": (False, "KEY_LEFTBRACE"), "]": (False, "KEY_RIGHTBRACE"),
+    "\\": (False, "KEY_BACKSLASH"), ";": (False, "KEY_SEMICOLON"), "'": (False, "KEY_APOSTROPHE"), "`": (False, "KEY_GRAVE"),
+    ",": (False, "KEY_COMMA"), ".": (False, "KEY_DOT"), "/": (False, "KEY_SLASH"),
+    "_": (True, "KEY_MINUS"), "+": (True, "KEY_EQUAL"), "{": (True, "KEY_LEFTBRACE"), "}": (True, "KEY_RIGHTBRACE"),
+    "|": (True, "KEY_BACKSLASH"), ":": (True, "KEY_SEMICOLON"), "\"": (True, "KEY_APOSTROPHE"), "~": (True, "KEY_GRAVE"),
+    "<": (True, "KEY_COMMA"), ">": (True, "KEY_DOT"), "?": (True, "KEY_SLASH"),
+}
+for char in "abcdefghijklmnopqrstuvwxyz":
+    typeableChars[char] = (False, "KEY_" + char.upper())
+    typeableChars[char.upper()] = (True, "KEY_" + char.upper())
+for char, shiftedChar in zip("1234567890", "!@#$%^&*()"):
+    typeableChars[char] = (False, "KEY_" + char)
+    typeableChars[shiftedChar] = (True, "KEY_" + char)
+
+macroCache = {} # A dict of compiled macros keyed by their binding str
+macroCacheSize = 256 # How many compiled macros to keep
+
+def getVirtualKeyboard():
+    """Return our virtual keyboard, creating it if need be. Return None if it can't be created."""
+    global virtualKeyboard
+
+    if virtualKeyboard == None: # If we haven't created it yet
+        try: # Try to...
+            virtualKeyboard = UInput({ecodes.EV_KEY: [code for code, name in keyNames.items() if name.startswith("KEY_")]}, name="keebie virtual keyboard") # Create a device that can press any key
+            dprint("Created virtual keyboard {}", virtualKeyboard.device)
+
+        except (OSError, UInputError) as error: # If /dev/uinput is missing or we lack permission
+            log(logNotice, "Can't create a virtual keyboard ({}), keys: and type: bindings need write access to /dev/uinput", error)
+
+    return virtualKeyboard
+
+def closeVirtualKeyboard():
+    """Destroy our virtual keyboard if we created one, releasing any keys it holds."""
+    global virtualKeyboard
+
+    if not virtualKeyboard == None:
+        virtualKeyboard.close()
+        virtualKeyboard = None
+
+def emitKeys(keyEvents):
+    """Emit a list of (key code, value) events through the virtual keyboard in a single write, followed by a SYN_REPORT."""
+    keyboard = getVirtualKeyboard()
+    if keyboard == None or keyEvents == []:
+        return
+
+    batch = b""
+    for code, value in keyEvents:
+        batch += inputEvent.pack(0, 0, ecodes.EV_KEY, code, value)
+    batch += inputEvent.pack(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+
+    os.write(keyboard.fd, batch)
+
+def compileMacro(macroStr):
+    """Compile a keys: or type: binding into a list of steps, each a list of (key code, value) events and the seconds to wait after them."""
+    if macroStr in macroCache: # If we've compiled it before
+        return macroCache[macroStr]
+
+    steps = []
+    keyDelay = settings["keyDelay"]
+
+    def addChord(keyNamesInChord, hold):
+        codes = [ecodes.ecodes[keyName] for keyName in keyNamesInChord]
+        steps.append([[(code, keyDown) for code in codes], max(hold, keyDelay)]) # Press the keys in order
+        steps.append([[(code, keyUp) for code in reversed(codes)], keyDelay]) # And release them in reverse
+
+    if macroStr.startswith("type:"): # If the macro is text to type
+        for char in macroStr[len("type:"):]:
+            if not char in typeableChars:
+                log(logNotice, "Can't type {!r}, skipping it", char)
+                continue
+
+            shifted, keyName = typeableChars[char]
+            addChord(["KEY_LEFTSHIFT", keyName] if shifted else [keyName], 0)
+
+    else: # If the macro is a list of chords
+        for token in macroStr[len("keys:"):].split():
+            try: # Try to...
+                if token.replace(".", "", 1).isdigit(): # If the token is a number, pause
+                    if not steps == []:
+                        steps[-1][1] += float(token)
+                    else:
+                        steps.append([[], float(token)])
+                    continue
+
+                chord, hold = (token.split("~") + ["0", ])[:2] # Split the chord from how long to hold it
+                addChord(chord.split("+"), float(hold))
+
+            except (KeyError, ValueError): # If a key name or a hold time is invalid
+                log(logNotice, "Invalid key or hold time in {}, skipping it", token)
+
+    if len(macroCache) >= macroCacheSize: # If the cache is full
+        macroCache.clear() # Start it over
+
+    macroCache[macroStr] = steps
+    return steps
+
+def playMacro(steps, stepIndex = 0):
+    """Emit the events of a compiled macro step and schedule the next one, so playback never blocks the main loop."""
+    while stepIndex < len(steps): # For all remaining steps
+        keyEvents, delay = steps[stepIndex]
+        emitKeys(keyEvents)
+        stepIndex += 1
+
+        if delay > 0 and stepIndex < len(steps): # If we have to wait before the next step
+            scheduler.schedule(delay, playMacro, steps, stepIndex) # Let the scheduler call us back
+            return
+
+
+
+# Keypress processing
+
+defaultRepeatInterval = 0.1 # Seconds between repeats of a repeat binding that doesn't set repeatInterval, on devices without kernel autorepeat
+
+def bindingCommand(binding): # Return the command str of a binding given either as a str or as a dict with options, argv bindings have none
+    if type(binding) == dict:
+        binding = binding.get("command", "")
+
+    return binding if type(binding) == str else ""
+
+def bindingArgv(binding): # Return the argv list of a binding given as a list (or a dict with a list command) to run without a shell, or None
+    if type(binding) == dict:
+        binding = binding.get("command", "")
+
+    return binding if type(binding) == list else None
+
+def isRepeatBinding(binding): # Return True if a binding should fire repeatedly while its keys are held
+    return type(binding) == dict and (binding.get("repeat", False) == True or "repeatInterval" in binding)
+
+policyOptions = ("minInterval", "debounce", "collapse", "maxInFlight") # Binding options that limit how often a binding fires
+
+def hasPolicy(binding): # Return True if a binding has options limiting how often it fires
+    return type(binding) == dict and any([option in binding for option in policyOptions])
+
+scriptTypes = { # A dict of script types and thier interpreters with a trailing space
+    "script": "bash ",
+    "py": "python ",
+    "py2": "python2 ",
+    "py3": "python3 ",
+    "exec": "",
+}
+
+runningCommands = [] # A list of (tag, Popen, journal entry, stderr file) of commands running in the background, tags are (device name, layer, keycode)
+
+journalSize = 512 # How many recently finished commands are kept in memory
+journal = [None, ] * journalSize # A ring buffer of journal entries, dicts describing a command a binding ran and how it went
+journalIndex = 0 # How many entries have ever been journaled, the next one goes into journal[journalIndex % journalSize]
+journalStderrSize = 512 # How many bytes of the end of a command's stderr are journaled
+journalFileSize = 1048576 # Bytes the on disk journal may grow to before it is rotated
+
+def runCommand(command, tag = None, environment = None):
+    """Run a shell command (or an argv list without a shell), in the background if it ends with "&" (so it can be tracked), otherwise wait for it."""
+    shell = type(command) == str
+    preexec = None if normalPriority == None else commandPriority # Without a preexec_fn subprocess can use vfork, which is much cheaper for a big process
+    background = command[-1] == "&" if not shell else command.strip().endswith("&")
+
+    if background == True: # If the command should run in the background
+        command = command.strip()[:-1] if shell else command[:-1] # Start it without the "&" so we keep track of it
+
+    device, layer, history = tag or (None, None, None)
+    entry = {"time": time.time(), "device": device, "layer": layer, "history": history, "command": command.strip() if shell else shlex.join(command), "background": background}
+
+    stderrFile = tempfile.TemporaryFile() # Collect stderr in a file so a chatty command can't fill a pipe and stall
+    process = subprocess.Popen(command, shell=shell, env=environment, preexec_fn=preexec, stderr=stderrFile) # Execute it
+    entry["spawn"] = time.time() - entry["time"]
+
+    if background == True:
+        runningCommands.append((tag, process, entry, stderrFile))
+
+    else:
+        while True: # And wait for it to finish
+            try: # Try to...
+                process.wait(1) # Wait a bit
+                break
+            except subprocess.TimeoutExpired: # If it's still running
+                pingService() # Make sure systemd's watchdog doesn't think we hung
+
+        finishCommand(process, entry, stderrFile)
+
+def finishCommand(process, entry, stderrFile):
+    """Journal a command that has finished, passing on what it wrote to stderr."""
+    entry["duration"] = time.time() - entry["time"] - entry["spawn"] # Background commands are only noticed once per loop, so their durations are rounded up to loopDelay
+    entry["exit"] = process.returncode
+
+    stderrFile.seek(0)
+    stderr = stderrFile.read()
+    stderrFile.close()
+
+    if not stderr == b"":
+        sys.stderr.buffer.write(stderr) # Pass it on like we did before we collected it
+        sys.stderr.flush()
+
+    entry["stderr"] = stderr[-journalStderrSize:].decode(errors="replace")
+
+    if not entry["exit"] == 0:
+        log(logNotice, "{}: {} exited with status {}", entry["history"], entry["command"], entry["exit"])
+
+    addJournalEntry(entry)
+
+def addJournalEntry(entry):
+    """Add an entry to our journal ring buffer, and to the on disk journal if the journalFile setting asks for it."""
+    global journalIndex
+
+    journal[journalIndex % journalSize] = entry
+    journalIndex += 1
+
+    if settings["journalFile"] == True:
+        try: # Try to...
+            if os.path.exists(journalPath) and os.path.getsize(journalPath) > journalFileSize: # If the journal is full
+                os.replace(journalPath, journalPath + ".1") # Rotate it, keeping one old journal
+
+            with open(journalPath, "at") as journalFile:
+                journalFile.write(json.dumps(entry) + "\n")
+
+        except OSError as error: # If the disk is full or such, keep running the bindings
+            dprint("Can't write journal: {}", error)
+
+def dumpJournal(path, entries = None):
+    """Write all entries in our journal ring buffer (or the list entries) to a file as JSON lines, oldest first."""
+    if entries == None:
+        entries = [journal[index % journalSize] for index in range(max(0, journalIndex - journalSize), journalIndex)]
+    lines = [json.dumps(entry) for entry in entries]
+
+    with open(path + ".tmp", "wt") as dumpFile: # Write a temporary file and move it into place so readers never see half a dump
+        dumpFile.write("".join([line + "\n" for line in lines]))
+    os.replace(path + ".tmp", path)
+
+def reapCommands():
+    """Journal and forget background commands that have finished."""
+    running = []
+    for tag, process, entry, stderrFile in runningCommands:
+        if process.poll() == None:
+            running.append((tag, process, entry, stderrFile))
+        else:
+            finishCommand(process, entry, stderrFile)
+
+    runningCommands[:] = running
+
+def countRunning(tag):
+    """Return how many background commands with a tag are still running."""
+    reapCommands()
+
+    return len([process for processTag, process, entry, stderrFile in runningCommands if processTag == tag])
+
+defaultVarTtl = 60 # Seconds a dynamic var's value is used for if the var doesn't set a ttl
+varCacheSize = 64 # How many dynamic var values are cached, the least recently used are evicted first
+varCache = {} # A dict of [value, expiry time, ttl, Popen, output file] by dynamic var command, in least recently used order
+
+def isDynamicVar(value): # Return True if a layer var is computed by a command (a dict like {"cmd": "hostname -i", "ttl": 30}) rather than a str
+    return type(value) == dict and "cmd" in value
+
+def refreshVar(var):
+    """Start running a dynamic var's command in the background to refresh its cached value, unless it is already running."""
+    command = var["cmd"]
+    entry = varCache.setdefault(command, [None, 0, var.get("ttl", defaultVarTtl), None, None])
+    entry[2] = var.get("ttl", defaultVarTtl) # Use the ttl of the var that last asked for a refresh
+
+    if not entry[3] == None: # If the command is already running
+        return
+
+    dprint("Refreshing dynamic var {}", command)
+    entry[4] = tempfile.TemporaryFile() # Collect the output in a file so a chatty command can't fill a pipe and stall
+    entry[3] = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=entry[4], preexec_fn=None if normalPriority == None else commandPriority) # Without a preexec_fn subprocess can use vfork
+
+    for cachedCommand in list(varCache.keys()): # Evict the least recently used values over the cache size
+        if len(varCache) <= varCacheSize:
+            break
+
+        if varCache[cachedCommand][3] == None: # Leave ones that are refreshing
+            varCache.pop(cachedCommand)
+
+def finishVar(command):
+    """Cache the output of a dynamic var's command that has finished."""
+    entry = varCache[command]
+
+    entry[4].seek(0)
+    entry[0] = entry[4].read().decode(errors="replace").rstrip("\n") # Use the output like $(command) would
+    entry[1] = time.time() + entry[2]
+    entry[4].close()
+    entry[3], entry[4] = None, None
+
+    dprint("Dynamic var {} is {}", command, entry[0])
+
+def reapVars():
+    """Cache the values of dynamic var commands that have finished."""
+    for command, entry in list(varCache.items()):
+        if not entry[3] == None and not entry[3].poll() == None:
+            finishVar(command)
+
+def warmVars(layer):
+    """Start refreshing all dynamic vars of a layer that have no cached value, so they are ready by the time a key uses them."""
+    for value in getLayerTable(layer)["vars"].values():
+        if isDynamicVar(value) and not value["cmd"] in varCache:
+            refreshVar(value)
+
+def dynamicVar(var):
+    """Return the cached value of a dynamic var (or None if there is none), refreshing it in the background if it expired. Never waits for the var's command."""
+    command = var["cmd"]
+
+    if not command in varCache or varCache[command][0] == None: # If there is no value to use
+        refreshVar(var) # Make sure the command is running (warmVars() started it when the layer was loaded)
+
+        if varCache[command][3].poll() == None: # If it hasn't finished
+            return None # Leave it running for the next keypress, reapVars() will cache its value
+
+        finishVar(command)
+
+    elif time.time() > varCache[command][1]: # If the value expired
+        refreshVar(var) # Refresh it, we use the stale value until that finishes
+
+    varCache[command] = varCache.pop(command) # Mark it as most recently used
+
+    return varCache[command][0]
+
+def parseVars(commandStr, layer, eventVars = None, failed = ""): # Given a command from the layer json file replace vars with their values (from eventVars first, then the layer) and return the string, or failed if a var has no value
+    # Vars we will need in the loop
+    returnStr = "" # The string to be retuned
     escaped = False # If we previously encountered an escape char
     escapeChar = "\\" # What is out escape char
     varChars = ("%", "%") # What characters start and end a varable name
@@ -628,10 +1981,22 @@ def parseVars(commandStr, layer): # Given a command from the layer json file rep
 
         if inVar == True and char == varChars[1] : # If we are in a varable and char ends it parse the varables value, add it to returnStr if valid, and reset inVar and varName
             try :
-                returnStr += readJson(layer)["vars"][varName]
+                if not eventVars == None and varName in eventVars:
+                    value = eventVars[varName]
+                else:
+                    value = getLayerTable(layer)["vars"][varName]
             except KeyError :
-                print(f"unknown var {varName} in command {commandStr}, skiping command")
-                return ""
+                log(logNotice, "unknown var {} in command {}, skiping command", varName, commandStr)
+                return failed
+
+            if isDynamicVar(value): # If the var is computed by a command
+                value = dynamicVar(value) # Look up its cached value
+
+                if value == None: # If its command hasn't produced one
+                    log(logNotice, "var {} has no value yet, skiping command", varName)
+                    return failed
+
+            returnStr += value
 
             inVar = False
             varName = ""
@@ -691,7 +2056,7 @@ def addKey(layer = "default.json", key = None, command = None, keycodeTimeout =
     if command == None:
         command = input("Enter the command you would like to attribute to a key on your second keyboard \n") # Get the command the user wishs to bind
 
-        if command.startswith("layer:"): # If the user entered a layer switch command
+        if command.startswith(layerSwitchCommands): # If the user entered a layer switch command
             if os.path.exists(command.split(':')[-1]+".json") == False: # Check if the layer json file exsits
                 createLayer(command.split(':')[-1]+".json") # If not create it
                 print("Created layer file: " + command.split(':')[-1]+".json") # And notify the user
@@ -1003,6 +2368,7 @@ def newDevice(eventPath = "/dev/input/"):
         "devFile": symlink_name,
         "udev_match_keys": selectedPropertiesList,
         "ignored_keys": [],
+        "passthrough": False,
     }
 
     writeJson(deviceName + ".json", deviceJsonDict, deviceDir) # Write device data into a json file
@@ -1032,97 +2398,618 @@ def removeDevice(name = None):
     end()
 
 
+def udevRuleText(matchKeys, symlinkName): # Return the text of a udev rule for a device, matching what setup_tools/udevRule.sh writes
+    ruleString = "".join([test + ", " for test in matchKeys])
+    return f'SUBSYSTEM=="input", {ruleString}MODE="0666", ENV{{SYSTEMD_USER_WANTS}}="keebie.service"  TAG+="systemd" SYMLINK+="{os.path.basename(symlinkName)}"'
 
-# Setup
+deviceNamePattern = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*") # Names --provision accepts, they end up in udev rules, file names and /dev
+udevMatchPattern = re.compile(r'[A-Z]+(\{[A-Za-z0-9_./-]+\})?(==|!=)"[^"\\\n]*"') # A single udev match key like ATTRS{phys}=="usb-1/input0"
 
-def firstUses(): # Setup to be run when a user first runs keebie
-    shutil.copytree(installDataDir + "data/", dataDir, dirs_exist_ok=True) # Copy template configuration files to user
-    print(f"Configuration files copied from {installDataDir}/data/ to {dataDir}") # And inform the user
+def provisionDevices(path, overwrite = False, priority = 85):
+    """Set up all devices listed in a JSON manifest (a list of device dicts, - for stdin) without prompting, with a single sudo call for all udev rules. Return True if they were set up.
 
+    Each device needs a "name" and either a "device" (an event file, like /dev/input/by-id/...-event-kbd) or a "phys" to match,
+    "match" may give udev match keys instead of matching phys, and any other keys (like "initial_layer" or "passthrough") go into the device file."""
+    try: # Try to...
+        if path == "-": # If we should read from stdin
+            manifest = json.load(sys.stdin)
+        else:
+            with open(path) as manifestFile:
+                manifest = json.load(manifestFile)
+    except (OSError, ValueError) as error: # If the manifest is missing or unparsable
+        print(f"Could not read manifest {path}: {error}")
+        return False
+
+    if not type(manifest) == list: # If the manifest isn't a list of devices
+        print(f"Could not read manifest {path}: expected a JSON list of devices")
+        return False
+
+    errors = [] # A list of problems with the manifest, nothing is set up if there are any
+    devices = [] # A list of (name, device data, udev rule filename, rule text) to set up
+    nodes = [] # Event files of the devices, for udev to apply the new rules to
+
+    for index, entry in enumerate(manifest):
+        if not type(entry) == dict: # If the device isn't a JSON object
+            errors += [f"device {index + 1}: not a JSON object", ]
+            continue
 
+        name = str(entry.get("name", "")).strip()
 
-# Inter-process communication
+        if name == "": # If the device has no name
+            errors += [f"device {index + 1}: no name", ]
+            continue
 
-def savePid():
-    """Save our PID into the PID file. Raise FileExistsError if the PID file already exists."""
-    dprint("Saving PID to " + pidPath)
+        if deviceNamePattern.fullmatch(name) == None: # If the name could break out of the udev rule or the paths it's used in
+            errors += [f"device {index + 1}: name {name!r} may only contain letters, digits, '_', '.' and '-'", ]
+            continue
 
-    global savedPid # Globalize savedPid
+        if name in [device[0] for device in devices]: # If the name is used twice
+            errors += [f"device {index + 1}: name {name} used twice", ]
+            continue
 
-    pid = os.getpid() # Get this process' PID
+        if os.path.exists(deviceDir + name + ".json") and overwrite == False: # If the device already exists
+            errors += [f"device {index + 1}: {name} already exists", ]
+            continue
 
-    if os.path.exists(pidPath) == False: # If no PID file already exists
-        with open(pidPath, "wt") as pidFile: # Create and open the PID file
-            pidFile.write(str(pid)) # Write our PID into it
-            savedPid = True # Record that we have saved our PID
+        phys = entry.get("phys")
+        if "device" in entry: # If we were given the device's event file
+            try: # Try to...
+                phys = InputDevice(entry["device"]).phys # Find its phys
+                nodes += [entry["device"], ]
+            except OSError as error: # If we can't open it
+                errors += [f"device {index + 1}: can't open {entry['device']} ({error})", ]
+                continue
 
-    else:
-        dprint("PID already recorded")
-        raise FileExistsError("PID already recorded")
+        elif not phys == None: # If we were given a phys find the event files that have it
+            physNodes = [eventFile for eventFile in list_devices() if InputDevice(eventFile).phys == phys]
+            if physNodes == [] and not "match" in entry: # If nothing has it (and we would match on it)
+                errors += [f"device {index + 1}: no event file has phys {phys!r}", ]
+                continue
+            nodes += physNodes
 
-def removePid():
-    """Remove the PID file if it exists."""
-    dprint("Removing PID file " + pidPath)
+        if "match" in entry: # If udev match keys were given
+            matchKeys = entry["match"]
+        elif not phys == None:
+            matchKeys = [f'ATTRS{{phys}}=="{phys}"']
+        else:
+            errors += [f"device {index + 1}: no device, phys or match for {name}", ]
+            continue
 
-    global savedPid # Globalize savedPid
+        if not type(matchKeys) == list or matchKeys == []: # If the match keys aren't a list
+            errors += [f"device {index + 1}: match for {name} must be a list of udev match keys", ]
+            continue
 
-    if os.path.exists(pidPath) == True: # If the PID file exists
-        os.remove(pidPath) # Remove it
-        savedPid = False # And record it's removal
+        badKeys = [key for key in matchKeys if not type(key) == str or udevMatchPattern.fullmatch(key) == None] # Keys that aren't a single KEY=="value" test
+        if not badKeys == []:
+            errors += [f"device {index + 1}: invalid udev match key(s) {', '.join([repr(key) for key in badKeys])}, expected KEY==\"value\" without quotes or backslashes in the value", ]
+            continue
 
-    else:
-        print("PID was never stored?")
+        initialLayer = layerFilename(entry.get("initial_layer", "default.json"))
+        deviceData = { # Construct the device data dict like newDevice() does
+            "initial_layer": initialLayer,
+            "devFile": "/dev/" + name,
+            "udev_match_keys": matchKeys,
+            "ignored_keys": [],
+            "passthrough": False,
+            "udev_rule": f"{priority}-keebie-{name}.rules",
+        }
+        deviceData.update({key: value for key, value in entry.items() if not key in ("name", "device", "phys", "match", "initial_layer")}) # Any other device options
 
-def getPid():
-    """Return the PID in the PID file. Raise FileNotFoundError if the file does not exist."""
-    if os.path.exists(pidPath) == True: # If the PID file exists
-        with open(pidPath, "rt") as pidFile: # Open it
-            return int(pidFile.read()) # And return it's contents as an int
+        devices += [(name, deviceData, deviceData["udev_rule"], udevRuleText(matchKeys, name)), ]
 
-    else:
-        dprint("PID file dosn't exist")
-        raise FileNotFoundError("PID file dosn't exist")
+    if not errors == []: # If anything was wrong
+        for error in errors:
+            print(error)
+        print("Nothing was set up")
+        return False
 
-def checkPid():
-    """Try to get the PID and check if it is valid. Raise FileNotFoundError if the PID file does not exist. Raise ProcessLookupError and remove the PID file if no process has the PID."""
-    pid = getPid() # Try to get the PID in the PID file, this will raise en exception if the file is missing
+    ruleDir = tempfile.mkdtemp() # Write all the rules where a single sudo call can install them
+    for name, deviceData, ruleFile, ruleText in devices:
+        with open(os.path.join(ruleDir, ruleFile), "wt") as rule:
+            rule.write(ruleText + "\n")
 
-    try:
-        os.kill(pid, 0) # Send signal 0 to the process, this will raise OSError if the process doesn't exist
-    
-    except OSError:
-        dprint("PID invalid")
-        removePid() # Remove the PID file since its wrong
-        raise ProcessLookupError("PID invalid")
+    sysNodes = ["/sys/class/input/" + os.path.basename(os.path.realpath(node)) for node in nodes] # The sysfs paths udev triggers for the event files
+    script = f"install -m 644 {' '.join([shlex.quote(os.path.join(ruleDir, device[2])) for device in devices])} /etc/udev/rules.d/ && udevadm control --reload"
+    for sysNode in sysNodes: # Apply the new rules to every matched node (creating their symlinks) rather than retriggering everything
+        script += f" && udevadm trigger --action=add {shlex.quote(sysNode)}"
 
-def sendStop():
-    """If a valid PID is found in the PID file send SIGINT to the process."""
-    try:
-        dprint("Sending stop")
+    print(f"Installing {len(devices)} udev rule(s) and triggering {len(sysNodes)} device(s), sudo may prompt you for a password.")
+    dprint(script)
+    result = subprocess.run(["sudo", "sh", "-c", script])
+    shutil.rmtree(ruleDir)
 
-        checkPid() # Check if the PID file point's to a valid process
-        
-        os.kill(getPid(), signal.SIGINT) # Stop the process
+    if not result.returncode == 0: # If installing the rules failed
+        print("Installing udev rules failed, no devices were set up")
+        return False
 
-    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't valid
-        dprint("No process to stop")
+    for name, deviceData, ruleFile, ruleText in devices: # Now that the rules are in place write the device files
+        if os.path.exists(layerDir + deviceData["initial_layer"]) == False: # If the device's layer does not exist
+            createLayer(deviceData["initial_layer"]) # Create it
 
-def sendPause(waitSafeTime=None):
-    """If a valid PID is found in the PID file send SIGUSR1 to the process."""
-    try:
-        dprint("Sending pause")
+        if os.path.exists(deviceDir + name + ".json"): # If we are replacing a device
+            os.remove(deviceDir + name + ".json") # Don't keep any of its old options
 
-        checkPid() # Check if the PID file point's to a valid process
+        writeJson(name + ".json", deviceData, deviceDir)
+        print(f"Set up device {name}")
 
-        global havePaused
-        havePaused = True # Save that we have paused the process
-        
-        os.kill(getPid(), signal.SIGUSR1) # Pause the process
+    return True
 
-        if waitSafeTime == None:
-            waitSafeTime = settings["loopDelay"] * 3 # Set how long we should wait
 
-        time.sleep(waitSafeTime) # Wait a bit to make sure the process paused itself
+
+# Bulk import/export
+
+recordTypes = ("binding", "var", "leds", "extends", "option") # Valid values for the type field of an import/export record
+jsonPrefixes = ("{", "[", '"') # CSV binding and var values starting with these are JSON, --export quotes plain strings that start with them
+
+def readRecords(path):
+    """Read a list of (lineNumber, type, name, value) records from a CSV file or a JSON lines file (or stdin if path is "-")."""
+    records = []
+
+    if path == "-": # If we should read from stdin
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, newline="") as f:
+            lines = f.read().splitlines()
+
+    if path.endswith(".csv"): # If the file is a CSV file
+        for row in csv.DictReader(lines): # For every row under the "type,name,value" header
+            value = row["value"]
+
+            if row["type"] == "leds": # If the row is a list of LEDs
+                value = [int(led) for led in value.replace(",", " ").split()] # Parse the comma and/or space separated list
+            elif row["type"] == "extends": # If the row is a list of parent layers
+                value = value.replace(",", " ").split()
+            elif row["type"] == "option": # If the row is a layer option
+                value = json.loads(value) # Its value is JSON
+            elif value.startswith(jsonPrefixes): # If the row may be a binding with options, an argv binding or a quoted string (or a hand written shell command like "{ echo a; }")
+                try: # Try to...
+                    value = json.loads(value) # Read it as JSON
+                except ValueError: # If it isn't JSON it's a shell command
+                    pass
+
+            records += [(row["type"], row["name"], value), ]
+
+    else: # Otherwise treat it as JSON lines
+        for line in lines:
+            if line.strip() == "": # Skip blank lines
+                continue
+
+            record = json.loads(line)
+            records += [(record["type"], record.get("name", ""), record["value"]), ]
+
+    return [(lineNumber + 1, ) + record for lineNumber, record in enumerate(records)] # Number the records so errors can point at them
+
+def importRecords(path, layer = "default.json", overwrite = False):
+    """Validate and merge the records in path into layer with a single write, return True if the layer was written."""
+    layer = layerFilename(layer)
+
+    try: # Try to...
+        layerData = readJson(layer) # Get the current contents of the layer
+    except FileNotFoundError: # If the layer doesn't exist yet
+        layerData = {"leds": [], "vars": {}}
+    except ValueError as error: # If the layer is unparsable
+        print(f"Could not read layer {layer}: {error}")
+        return False
+
+    try: # Try to...
+        records = readRecords(path)
+    except (OSError, ValueError, KeyError) as error: # If the file is missing, unparsable or lacks fields
+        print(f"Could not read {path}: {error}")
+        return False
+
+    newData = {} # Bindings and LEDs to write
+    newVars = {} # Vars to write
+    errors = [] # Problems that stop the import
+    skipped = 0 # Number of records identical to what we already have
+
+    for lineNumber, recordType, name, value in records: # For every record
+        if not recordType in recordTypes: # If we don't know the record type
+            errors += [f"record {lineNumber}: unknown type {recordType}", ]
+            continue
+
+        if recordType == "binding":
+            for problem in validateKeycode(name): # Check the key names against evdev
+                errors += [f"record {lineNumber}: {problem} in {name}", ]
+
+            section, key, old = newData, name, layerData.get(name)
+
+        elif recordType == "var":
+            section, key, old = newVars, name, layerData.get("vars", {}).get(name)
+
+        elif recordType == "option":
+            if not name in layerMetaKeys or name in ("leds", "vars", "extends"): # If the name isn't a layer option (or has its own record type)
+                errors += [f"record {lineNumber}: unknown layer option {name}", ]
+                continue
+
+            section, key, old = newData, name, layerData.get(name)
+
+        else: # If the record is a list of LEDs or parent layers
+            section, key, old = newData, recordType, layerData.get(recordType)
+
+        if key in section: # If the file sets the same thing twice
+            if section[key] != value: # With different values
+                errors += [f"record {lineNumber}: conflicting {recordType} {key}, already set to {section[key]!r} by this file", ]
+            else:
+                dprint("record {}: duplicate {} {}", lineNumber, recordType, key)
+            continue
+
+        if old != None and old != value and recordType in ("binding", "var"): # If the layer already has a different value
+            if overwrite == False:
+                errors += [f"record {lineNumber}: {recordType} {key} is already {old!r} in {layer}, use --overwrite to replace it", ]
+                continue
+
+            qprint("Overwriting {} {}: {!r} -> {!r}", recordType, key, old, value)
+
+        elif old == value: # If the layer already has this exact value
+            skipped += 1
+
+        section[key] = value
+
+    if not errors == []: # If anything was wrong don't write anything
+        for error in errors:
+            print(error)
+        print(f"Import aborted, {len(errors)} problem(s) found, {layer} was not changed")
+        return False
+
+    if not newVars == {}: # If we have vars merge them with the existing ones
+        newData["vars"] = {**layerData.get("vars", {}), **newVars}
+
+    if os.path.exists(layerDir + layer) == False: # If we are creating the layer start from the keys every layer has
+        newData = {**layerData, **newData}
+
+    writeJson(layer, newData) # Write everything in one pass
+    print(f"Imported {len(records)} record(s) into {layer} ({skipped} unchanged)")
+    return True
+
+def exportRecords(layer = "default.json", path = "-"):
+    """Dump the bindings, vars and LEDs of layer as a CSV file or JSON lines file (or stdout if path is "-"), return True if it was dumped."""
+    try: # Try to...
+        layerData = readJson(layerFilename(layer))
+    except (OSError, ValueError) as error: # If the layer is missing or unparsable
+        print(f"Could not read layer {layerFilename(layer)}: {error}")
+        return False
+
+    records = [("leds", "", layerData.get("leds", []))] # Build a list of (type, name, value) records
+    if "extends" in layerData: # If the layer has parents
+        records += [("extends", "", layerData["extends"]), ]
+    records += [("option", name, value) for name, value in layerData.items() if name in layerMetaKeys and not name in ("leds", "vars", "extends")]
+    records += [("var", name, value) for name, value in layerData.get("vars", {}).items()]
+    records += [("binding", name, value) for name, value in layerData.items() if not name in layerMetaKeys]
+
+    if path == "-": # If we should write to stdout
+        outfile = sys.stdout
+    else:
+        outfile = open(path, "w", newline="")
+
+    if path.endswith(".csv"): # If we should write a CSV file
+        writer = csv.writer(outfile)
+        writer.writerow(("type", "name", "value"))
+
+        for recordType, name, value in records:
+            if recordType == "leds":
+                value = " ".join([str(led) for led in value]) # Write LEDs as a space separated list
+            elif recordType == "extends":
+                value = " ".join(layerParents({"extends": value})) # Write parent layers as a space separated list
+            elif recordType == "option" or not type(value) == str or value.startswith(jsonPrefixes):
+                value = json.dumps(value) # Write options, bindings with options, argv bindings and strings that would read as JSON as JSON
+
+            writer.writerow((recordType, name, value))
+
+    else: # Otherwise write JSON lines
+        for recordType, name, value in records:
+            outfile.write(json.dumps({"type": recordType, "name": name, "value": value}) + "\n")
+
+    if not outfile == sys.stdout:
+        outfile.close()
+        qprint("Exported {} record(s) from {} to {}", len(records), layerFilename(layer), path)
+
+    return True
+
+
+
+# Layer checking
+
+eventVarNames = ("count", "delta", "value") # Vars given to commands by axis bindings and binding policies rather than layers
+
+def commandVars(command): # Return a list of the names of vars used in a command, skipping escaped chars like parseVars() does
+    names = []
+    escaped = False
+    varName = None # The name of the var we are in so far, None if we aren't in one
+    for char in command:
+        if escaped == True:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "%":
+            if varName == None:
+                varName = ""
+            else:
+                names.append(varName)
+                varName = None
+        elif not varName == None:
+            varName += char
+
+    return names
+
+def noDuplicateKeys(pairs): # An object_pairs_hook for json.load() that raises ValueError on keys given twice
+    data = {}
+    for key, value in pairs:
+        if key in data:
+            raise ValueError(f"{key} is given twice")
+        data[key] = value
+
+    return data
+
+def checkLayer(layer, devices):
+    """Return a list of (level, message) problems with a layer and its compiled (flattened table, files, indexes), or None if it can't be compiled.
+
+    devices is a list of the device dicts of devices that can reach the layer."""
+    problems = []
+
+    try: # Try to...
+        with open(layerDir + layer) as layerFile:
+            layerData = json.load(layerFile, object_pairs_hook=noDuplicateKeys) # Catch syntax errors and conflicting bindings the daemon wouldn't notice
+        layerTable, files = flattenLayer(layer)
+    except (ValueError, FileNotFoundError) as error: # JSONDecodeError is a ValueError
+        return [("error", str(error)), ], None
+
+    for parent in layerParents(layerData):
+        if not os.path.exists(layerDir + layerFilename(parent)):
+            problems += [("warning", f"extends missing layer {parent}"), ]
+
+
+    multiKeyMode = layerTable.get("multiKeyMode", settings["multiKeyMode"])
+    compilable = True # Whether the layer can be indexed
+    for binding, value in layerTable.items():
+        if binding == "vars":
+            for name, var in value.items():
+                if not type(var) == str and not isDynamicVar(var):
+                    problems += [("error", f"var {name} must be a str or a dict with a cmd"), ]
+            continue
+
+        if binding in layerMetaKeys:
+            continue
+
+        for problem in validateKeycode(binding): # Check the key names against evdev
+            problems += [("error", f"{binding}: {problem}"), ]
+
+        command = value.get("command") if type(value) == dict else value
+        if not type(command) in (str, list) or type(command) == list and (command == [] or not all([type(arg) == str for arg in command])):
+            problems += [("error", f"{binding}: bindings must be a str, a list of str args or a dict with either as its command"), ]
+            compilable = False # The daemon can't index this layer
+            continue
+
+        for name in sum([commandVars(arg) for arg in command], []) if type(command) == list else commandVars(command): # Check every var the command uses exists
+            if not name in layerTable["vars"] and not name in eventVarNames:
+                problems += [("error", f"{binding}: unknown var %{name}%, the binding would never run"), ]
+
+        command = bindingCommand(value)
+
+        if command.startswith(layerSwitchCommands) and not "%" in command: # If the binding switches layers
+            target = layerFilename(command.split(":", 1)[1])
+            if not os.path.exists(layerDir + target):
+                problems += [("warning", f"{binding}: layer {target} doesn't exist, it will be created when keebie starts"), ]
+
+        if isAxisBinding(binding):
+            continue
+
+        for peak in binding.split("-"): # Check for peaks no ledger can produce
+            keys = [key for key in peak.split("+") if not key == "HELD"]
+            if not len(set(keys)) == len(keys):
+                problems += [("error", f"{binding}: {peak} has a key twice, the binding can never fire"), ]
+            elif multiKeyMode == "combination" and not keys == sorted(keys):
+                problems += [("error", f"{binding}: combinations are sorted in combination mode, write {'+'.join(sorted(keys))}{'+HELD' * peak.endswith('+HELD')}"), ]
+
+            ignoredBy = [device["name"] for device in devices if any([key in device["ignored_keys"] for key in keys])]
+            if not devices == [] and len(ignoredBy) == len(devices):
+                problems += [("error", f"{binding}: uses keys ignored by every device that reaches this layer ({', '.join(ignoredBy)})"), ]
+                break
+
+    if compilable == False:
+        return problems, None
+
+    index = indexLayer(layerTable, layer)
+    for setting in ledgerSettings: # indexLayer() warns about and leaves out invalid ledger settings
+        if setting in layerTable and not setting in index["timing"]:
+            problems += [("error", f"invalid {setting} {layerTable[setting]}"), ]
+
+    for binding in layerTable.keys(): # Report bindings that wait for the flush timeout because others start with them
+        if binding in layerMetaKeys or isAxisBinding(binding):
+            continue
+
+        for other in layerTable.keys():
+            if not other == binding and not other in layerMetaKeys and other.startswith(binding + "-"):
+                problems += [("note", f"{binding} waits flushTimeout after release because {other} starts with it"), ]
+                break
+
+        options = layerTable[binding] if type(layerTable[binding]) == dict else {}
+        if options.get("immediate", layerTable.get("immediate", False)) == True and not binding in index["immediate"] and not "-" in binding and not binding.endswith("+HELD"):
+            problems += [("warning", f"{binding} is immediate but another binding starts with its keys, it fires after release"), ]
+
+        if bindingCommand(layerTable[binding]).startswith("layer-hold:") and not binding in index["immediate"]: # If a momentary layer can't fire on press its keys are already up when it does
+            reason = "it only fires after release" if "-" in binding or binding.endswith("+HELD") else "another binding starts with its keys, so it fires after release"
+            problems += [("warning", f"{binding} holds a layer but {reason} and the layer stays on like layer-push: until a layer-pop:"), ]
+
+    return problems, (layerTable, files, index)
+
+def checkLayers():
+    """Check every layer file, print what's wrong with them, and save the flattened layers and indexes for the loop to load. Return the number of errors."""
+    layers = sorted([filename for filename in os.listdir(layerDir) if filename.endswith(".json")])
+
+    devices = [] # The device dicts of all devices
+    for deviceJson in sorted(os.listdir(deviceDir)):
+        if deviceJson.endswith(".json"):
+            devices += [{"name": deviceJson[:-len(".json")], **readJson(deviceJson, deviceDir)}, ]
+
+    reachedBy = {} # A dict of lists of devices that can reach each layer
+    usedAsParent = set() # Layers other layers extend
+    for device in devices: # Follow every device's switch bindings from its initial layer
+        pending = [layerFilename(device["initial_layer"]), ]
+        while not pending == []:
+            layer = pending.pop()
+            if device in reachedBy.setdefault(layer, []) or not os.path.exists(layerDir + layer):
+                continue
+            reachedBy[layer].append(device)
+
+            try:
+                layerData = readJson(layer)
+            except ValueError: # Syntax errors are reported below
+                continue
+
+            usedAsParent.update([layerFilename(parent) for parent in layerParents(layerData)])
+            for value in layerData.values():
+                command = bindingCommand(value) if type(value) in (str, dict) else ""
+                if command.startswith(layerSwitchCommands) and not "%" in command:
+                    pending.append(layerFilename(command.split(":", 1)[1]))
+
+    counts = {"error": 0, "warning": 0, "note": 0}
+    cache = {} # Flattened and indexed layers for the loop
+    for layer in layers:
+        problems, compiled = checkLayer(layer, reachedBy.get(layer, []))
+        if not compiled == None:
+            cache[layer] = compiled
+
+        if not layer in reachedBy and not layer in usedAsParent: # If no device can ever use the layer
+            problems += [("note", "no device can reach this layer"), ]
+
+        for level, message in problems:
+            counts[level] += 1
+            print(f"{layer}: {level}: {message}")
+
+    with open(layerCachePath + ".tmp", "wb") as cacheFile:
+        pickle.dump({"version": layerCacheVersion, "indexes": sorted(indexLayer({"vars": {}}).keys()), "layers": cache}, cacheFile) # Note the index names too in case a change forgets to bump the version
+    os.replace(layerCachePath + ".tmp", layerCachePath)
+
+    print(f"Checked {len(layers)} layer(s): {counts['error']} error(s), {counts['warning']} warning(s), {counts['note']} note(s)")
+    qprint("Saved compiled layers to {}", layerCachePath)
+
+    return counts["error"]
+
+def loadLayerCache():
+    """Load the layers compiled by --check, dropping any whose files changed since. Caches written by another version of keebie are ignored, the layers are compiled as they are used instead."""
+    try: # Try to...
+        with open(layerCachePath, "rb") as cacheFile:
+            cache = pickle.load(cacheFile)
+
+        if not type(cache) == dict or not cache.get("version") == layerCacheVersion or not cache.get("indexes") == sorted(indexLayer({"vars": {}}).keys()): # If it has another layout
+            log(logNotice, "Ignoring layer cache from another version of keebie, run --check to rebuild it")
+            return
+
+        layers = {layer: (dict(layerTable), {filename: float(mtime) for filename, mtime in files.items()}, dict(index)) for layer, (layerTable, files, index) in cache["layers"].items()}
+    except FileNotFoundError: # If there is no cache
+        return
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, ValueError, TypeError) as error: # If it isn't a cache we can read
+        log(logNotice, "Ignoring unreadable layer cache ({}), run --check to rebuild it", error)
+        return
+
+    for layer, (layerTable, files, index) in layers.items():
+        layerTables[layer], layerTableFiles[layer], layerIndexes[layer] = layerTable, files, index
+
+    dprint("Loaded compiled layers {}", list(layers.keys()))
+    checkLayerTables(True) # Drop the ones that are out of date
+
+
+
+# Setup
+
+def firstUses(): # Setup to be run when a user first runs keebie
+    shutil.copytree(installDataDir + "data/", dataDir, dirs_exist_ok=True) # Copy template configuration files to user
+    print(f"Configuration files copied from {installDataDir}/data/ to {dataDir}") # And inform the user
+
+
+
+# Inter-process communication
+
+def savePid():
+    """Save our PID into the PID file. Raise FileExistsError if the PID file already exists."""
+    dprint("Saving PID to {}", pidPath)
+
+    global savedPid # Globalize savedPid
+
+    pid = os.getpid() # Get this process' PID
+
+    if os.path.exists(pidPath) == False: # If no PID file already exists
+        with open(pidPath, "wt") as pidFile: # Create and open the PID file
+            pidFile.write(f"{pid}\n{signalVersion}\n") # Write our PID into it, and which signals we handle
+            savedPid = True # Record that we have saved our PID
+
+    else:
+        dprint("PID already recorded")
+        raise FileExistsError("PID already recorded")
+
+def removePid():
+    """Remove the PID file if it exists."""
+    dprint("Removing PID file {}", pidPath)
+
+    global savedPid # Globalize savedPid
+
+    if os.path.exists(pidPath) == True: # If the PID file exists
+        os.remove(pidPath) # Remove it
+        savedPid = False # And record it's removal
+
+    else:
+        log(logNotice, "PID was never stored?")
+
+def getPid():
+    """Return the PID in the PID file. Raise FileNotFoundError if the file does not exist."""
+    if os.path.exists(pidPath) == True: # If the PID file exists
+        with open(pidPath, "rt") as pidFile: # Open it
+            return int(pidFile.read().split()[0]) # And return it's first line as an int
+
+    else:
+        dprint("PID file dosn't exist")
+        raise FileNotFoundError("PID file dosn't exist")
+
+def getSignalVersion():
+    """Return the signal version in the PID file, 0 if the instance that wrote it predates signal versions. Raise FileNotFoundError if the file does not exist."""
+    with open(pidPath, "rt") as pidFile: # Open the PID file
+        fields = pidFile.read().split()
+
+    return int(fields[1]) if len(fields) > 1 else 0 # Return the version after the PID, if any
+
+def checkPid():
+    """Try to get the PID and check if it is valid. Raise FileNotFoundError if the PID file does not exist. Raise ProcessLookupError and remove the PID file if no process has the PID."""
+    pid = getPid() # Try to get the PID in the PID file, this will raise en exception if the file is missing
+
+    try:
+        os.kill(pid, 0) # Send signal 0 to the process, this will raise OSError if the process doesn't exist
+    
+    except OSError:
+        dprint("PID invalid")
+        removePid() # Remove the PID file since its wrong
+        raise ProcessLookupError("PID invalid")
+
+logDumpSignal = signal.SIGRTMIN # The signal asking a running instance to dump its log ring buffer
+journalDumpSignal = signal.SIGRTMIN + 2 # The signal asking a running instance to dump its journal
+
+def sendStop():
+    """If a valid PID is found in the PID file send SIGINT to the process."""
+    try:
+        dprint("Sending stop")
+
+        checkPid() # Check if the PID file point's to a valid process
+        
+        os.kill(getPid(), signal.SIGINT) # Stop the process
+
+    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't valid
+        dprint("No process to stop")
+
+def sendPause(waitSafeTime=None):
+    """If a valid PID is found in the PID file send SIGUSR1 to the process."""
+    try:
+        dprint("Sending pause")
+
+        checkPid() # Check if the PID file point's to a valid process
+
+        global havePaused
+        havePaused = True # Save that we have paused the process
+        
+        os.kill(getPid(), signal.SIGUSR1) # Pause the process
+
+        if waitSafeTime == None:
+            waitSafeTime = settings["loopDelay"] * 3 # Set how long we should wait
+
+        time.sleep(waitSafeTime) # Wait a bit to make sure the process paused itself
 
     except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't valid
         dprint("No process to pause")
@@ -1142,29 +3029,721 @@ def sendResume():
     except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't 
         dprint("No process to resume")
 
+def sendDumpLog():
+    """If a valid PID is found in the PID file ask the process to dump its log ring buffer, and print the dump."""
+    try:
+        dprint("Sending log dump")
+
+        checkPid() # Check if the PID file point's to a valid process
+
+        if getSignalVersion() < 1: # If the instance would be killed by logDumpSignal rather than handle it
+            print("The running keebie instance is too old to dump its log, restart it first")
+            return
+
+        if os.path.exists(logDumpPath): # Remove any old dump so we know when the new one is written
+            os.remove(logDumpPath)
+
+        os.kill(getPid(), logDumpSignal) # Ask the process to dump its log
+
+        for attempt in range(0, 100): # Wait for the dump (up to a second)
+            if os.path.exists(logDumpPath):
+                with open(logDumpPath, "rt") as dumpFile:
+                    for line in dumpFile: # For every record dumped
+                        record = json.loads(line)
+                        print(line.rstrip("\n") if jsonLogs == True else f"{time.strftime('%H:%M:%S', time.localtime(record['time']))} {record['level']}: {record['message']}")
+                return
+
+            time.sleep(0.01)
+
+        print("The running keebie instance didn't dump its log")
+
+    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't valid
+        print("No running keebie instance to dump the log of")
+
+def dumpLogHandler(signal, frame):
+    """Dump our log ring buffer to logDumpPath."""
+    dumpLog(logDumpPath)
+
+def readJournal():
+    """Return the journal entries of a running instance, or those journaled to disk if no instance is running."""
+    try: # Try to...
+        checkPid() # Check if the PID file point's to a valid process
+
+        if getSignalVersion() < 1: # If the instance would be killed by journalDumpSignal rather than handle it
+            raise ProcessLookupError("Instance predates journal dumps")
+
+        if os.path.exists(journalDumpPath): # Remove any old dump so we know when the new one is written
+            os.remove(journalDumpPath)
+
+        os.kill(getPid(), journalDumpSignal) # Ask the process to dump its journal
+
+        for attempt in range(0, 100): # Wait for the dump (up to a second)
+            if os.path.exists(journalDumpPath):
+                with open(journalDumpPath, "rt") as dumpFile:
+                    return [json.loads(line) for line in dumpFile]
+
+            time.sleep(0.01)
+
+        print("The running keebie instance didn't dump its journal")
+
+    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist, the process isn't valid or can't dump its journal
+        dprint("No running keebie instance to ask, reading the journal files")
+
+    entries = []
+    for filename in sorted(os.listdir(dataDir)): # Journals of all workers and rotated journals
+        if filename.startswith("journal") and (filename.endswith(".log") or filename.endswith(".log.1")):
+            with open(dataDir + filename, "rt") as journalFile:
+                entries += [json.loads(line) for line in journalFile if not line.strip() == ""]
+
+    return sorted(entries, key=lambda entry: entry["time"])
+
+def printJournal(match = ""):
+    """Print the journaled commands whose device, layer, history or command contain match, followed by a summary per binding of the slowest and failing ones."""
+    entries = [entry for entry in readJournal() if any([match in str(entry[field]) for field in ("device", "layer", "history", "command")])]
+
+    if jsonLogs == True: # If the user wants JSON lines
+        for entry in entries:
+            print(json.dumps(entry))
+        return
+
+    if entries == []:
+        print("No commands journaled")
+        return
+
+    bindings = {} # A dict of [runs, failures, total duration, longest duration] by (device, layer, history)
+    for entry in entries:
+        print(f"{time.strftime('%H:%M:%S', time.localtime(entry['time']))} {entry['device']} {entry['layer']} {entry['history']}: exit {entry['exit']}, spawn {entry['spawn'] * 1000:.1f}ms, ran {entry['duration'] * 1000:.1f}ms{' (background)' * entry['background']}: {entry['command']}")
+        for line in entry["stderr"].splitlines(): # Show the end of what the command wrote to stderr
+            print(f"    {line}")
+
+        summary = bindings.setdefault((entry["device"], entry["layer"], entry["history"]), [0, 0, 0, 0])
+        summary[0] += 1
+        summary[1] += not entry["exit"] == 0
+        summary[2] += entry["duration"]
+        summary[3] = max(summary[3], entry["duration"])
+
+    print()
+    print("Slowest bindings:")
+    for (device, layer, history), (runs, failures, total, longest) in sorted(bindings.items(), key=lambda item: item[1][2], reverse=True):
+        print(f"{device} {layer} {history}: {runs} run(s), {failures} failed, {total / runs * 1000:.1f}ms average, {longest * 1000:.1f}ms longest")
+
+def dumpJournalHandler(signal, frame):
+    """Dump our journal ring buffer to journalDumpPath, or the merged journals of our workers if we supervise any."""
+    if supervising == False:
+        dumpJournal(journalDumpPath)
+        return
+
+    shards = [shard for shard, worker in workers.items() if worker[0].poll() == None]
+    for shard in shards: # Remove any old dumps so we know when the new ones are written
+        if os.path.exists(journalDumpPath + "." + shard):
+            os.remove(journalDumpPath + "." + shard)
+
+    signalWorkers(journalDumpSignal) # Ask every worker to dump its journal
+
+    entries = []
+    for attempt in range(0, 50): # Wait for the dumps (up to half a second, --journal waits a second for ours)
+        if all([os.path.exists(journalDumpPath + "." + shard) for shard in shards]):
+            break
+        time.sleep(0.01)
+
+    for shard in shards:
+        try: # Try to...
+            with open(journalDumpPath + "." + shard, "rt") as dumpFile:
+                entries += [json.loads(line) for line in dumpFile]
+            os.remove(journalDumpPath + "." + shard)
+        except FileNotFoundError: # If the worker didn't dump in time
+            log(logNotice, "Worker for {} didn't dump its journal", shard)
+
+    dumpJournal(journalDumpPath, sorted(entries, key=lambda entry: entry["time"]))
+
 def pause(signal, frame):
     """Ungrab all macro devices."""
-    print("Pausing...")
+    log(logNotice, "Pausing...")
 
     global paused
     paused = True # Save that we have been paused)
+    stateBlock.changed = True
 
-    ungrabMacroDevices() # Ungrab all devices so the pausing process can use them
-    closeDevices() # Close our macro devices
+    if supervising == False: # If we grabbed our devices ourselves
+        ungrabMacroDevices() # Ungrab all devices so the pausing process can use them
+        closeDevices() # Close our macro devices
+
+    signalWorkers(signal) # Pause any workers we supervise too
 
 def resume(signal, frame):
     """Grab all macro devices and refresh our setting after being paused (or just if some changes were made we need to load)."""
-    print("Resuming...")
+    log(logNotice, "Resuming...")
 
     global paused
     
     getSettings() # Refresh our settings
+    checkLayerTables(True) # Drop any flattened layers whose files were edited while we were paused
 
     if paused == True: # If we were paused prior
         setupMacroDevices() # Set our macro devices up again to detect changes
-        grabMacroDevices() # Grab all our devices back
+
+        if supervising == False: # If we don't leave our devices to workers
+            grabMacroDevices() # Grab all our devices back
 
     paused = False # Save that we are no longer paused
+    stateBlock.changed = True
+    signalWorkers(signal) # Resume any workers we supervise too, superviseWorkers() will start workers for new devices
+
+
+
+# State block
+
+statePath = os.environ.get("XDG_RUNTIME_DIR", dataDir.rstrip("/")) + "/keebie.state" # A path into which a running looping instance publishes its state
+
+class stateBlock():
+    """A class for publishing the state of a running keebie loop in a fixed layout memory mapped file, so status bars can poll it without IPC.
+
+    The file starts with a header (magic b"KEEB", version, number of device slots, sequence number, paused flag, timestamp of the last update, PID of the publisher)
+    followed by one fixed size slot per device (name, current layer, held keys, last history, LED bitmask, event and dispatch counters).
+    All fields are little endian and strs are utf-8, null padded. The sequence number is odd while an update is being written,
+    readers should retry if it is odd or changes while they read."""
+    header = struct.Struct("<4sHHIB3xdI4x") # magic, version, slots, sequence, paused, timestamp, pid
+    slot = struct.Struct("<32s64s128s128sIQQ4x") # name, layer, held keys, last history, LED bitmask, events, dispatches
+    magic = b"KEEB"
+    version = 2
+
+    changed = False # Set when something we publish might have changed, so the main loop knows to publish
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self.sequence = 0
+
+        size = self.header.size + self.slot.size * slots
+
+        self.file = open(path + ".tmp", "w+b") # Create the file at its full size
+        self.file.write(b"\0" * size)
+        self.file.flush()
+        os.replace(path + ".tmp", path) # And move it into place, truncating the old file would crash readers that have it mapped
+
+        self.map = mmap.mmap(self.file.fileno(), size) # Map it into memory
+
+    def publish(self, devices, isPaused):
+        """Write the state of a list of macroDevices into the block."""
+        self.sequence += 1 # Odd, readers will know we are writing
+        self.header.pack_into(self.map, 0, self.magic, self.version, self.slots, self.sequence, isPaused, time.time(), os.getpid())
+
+        for slotIndex, device in enumerate(devices[:self.slots]): # For every device we have a slot for
+            leds = 0
+            for led in device.ledsOn: # Build a bitmask of LEDs on
+                leds |= 1 << led
+
+            self.slot.pack_into(self.map, self.header.size + self.slot.size * slotIndex,
+                device.name.encode(), device.currentLayer.encode(), device.ledger.downKeysStr().encode(), device.lastHistory.encode(),
+                leds, device.eventCount, device.dispatchCount)
+
+        self.sequence += 1 # Even, the block is consistent again
+        struct.pack_into("<I", self.map, 8, self.sequence)
+
+        stateBlock.changed = False
+
+    def close(self):
+        """Unmap and remove the file."""
+        self.map.close()
+        self.file.close()
+
+        try: # Try to...
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+state = None # The stateBlock of this process if it is a running looping instance
+
+def publishState():
+    """Publish our state if it changed, (re)creating the state block if the number of devices changed."""
+    global state
+
+    if state == None or not state.slots == len(macroDeviceList): # If we need a (new) block
+        if not state == None:
+            state.close()
+
+        state = stateBlock(statePath, len(macroDeviceList))
+        stateBlock.changed = True
+
+    if stateBlock.changed == True:
+        state.publish(macroDeviceList, paused)
+
+def readState(path = statePath):
+    """Read a consistent copy of a state block and return it as a dict. Raise FileNotFoundError if no block is published, ValueError if it isn't a state block we can read,
+    ProcessLookupError if the process that published it is gone, or TimeoutError if no consistent copy could be read."""
+    with open(path, "rb") as stateFile:
+        stateMap = mmap.mmap(stateFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        for attempt in range(0, 1000): # Until we get a consistent read
+            magic, version, slots, sequence, isPaused, timestamp, pid = stateBlock.header.unpack_from(stateMap, 0)
+            if not (magic, version) == (stateBlock.magic, stateBlock.version): # If this isn't a block we know how to read
+                raise ValueError(f"{path} is not a version {stateBlock.version} keebie state block")
+
+            if attempt == 0: # Make sure the publisher is still running, a crashed instance leaves its block behind
+                try:
+                    os.kill(pid, 0) # Send signal 0 to the process, this will raise ProcessLookupError if the process doesn't exist
+                except PermissionError: # If it runs as another user it exists
+                    pass
+
+            if sequence % 2 == 1: # If the block is being written
+                continue
+
+            devices = []
+            for slotIndex in range(0, slots):
+                fields = stateBlock.slot.unpack_from(stateMap, stateBlock.header.size + stateBlock.slot.size * slotIndex)
+                name, layer, downKeys, lastHistory = [field.rstrip(b"\0").decode(errors="ignore") for field in fields[:4]]
+
+                devices += [{
+                    "name": name,
+                    "layer": layer,
+                    "held": downKeys,
+                    "last_history": lastHistory,
+                    "leds": [led for led in range(0, 32) if fields[4] & 1 << led],
+                    "events": fields[5],
+                    "dispatches": fields[6],
+                }, ]
+
+            if stateBlock.header.unpack_from(stateMap, 0)[3] == sequence: # If nothing changed while we read
+                return {"paused": bool(isPaused), "updated": timestamp, "devices": devices}
+
+        raise TimeoutError("State block is stuck mid update")
+
+    finally:
+        stateMap.close()
+
+
+
+def readStates():
+    """Read the state blocks of a running instance and of any workers it supervises, and return them merged into one dict like readState() does. Raise FileNotFoundError if none are published."""
+    stateDir, stateName = os.path.split(statePath)
+    paths = [os.path.join(stateDir, filename) for filename in sorted(os.listdir(stateDir)) if (filename == stateName or filename.startswith(stateName + ".")) and not filename.endswith(".tmp")] # Skip blocks still being created
+
+    states = []
+    for path in paths:
+        try: # Try to...
+            states += [readState(path), ]
+        except FileNotFoundError: # If a worker just stopped
+            pass
+        except (ProcessLookupError, ValueError) as error: # If the block was left by a crashed process or isn't one we can read
+            dprint("Skipping state block {} ({})", path, error)
+
+    if states == []: # If nothing is published
+        raise FileNotFoundError(statePath)
+
+    return {
+        "paused": any([blockState["paused"] for blockState in states]),
+        "updated": max([blockState["updated"] for blockState in states]),
+        "devices": sum([blockState["devices"] for blockState in states], []),
+    }
+
+
+
+# Service notification
+
+notifySocket = None # A socket connected to systemd's notify socket, if we were started by a Type=notify unit
+watchdogInterval = None # Seconds between watchdog pings, half of what systemd expects
+lastWatchdog = 0 # When we last pinged the watchdog
+statusInterval = 5 # Seconds between status updates
+lastStatus = 0 # When we last sent a status update
+lastStatusEvents = 0 # The total event count of our devices when we last sent a status update
+
+def setupNotify():
+    """Connect to systemd's notify socket and find out if it expects watchdog pings, doing nothing if we weren't started by systemd."""
+    global notifySocket, watchdogInterval
+
+    if "KEEBIE_NOTIFY_FD" in os.environ: # If we are a worker our supervisor listens instead of systemd
+        notifySocket = socket.socket(fileno=int(os.environ.pop("KEEBIE_NOTIFY_FD")))
+        notifySocket.setblocking(False) # Never wait for a busy supervisor
+        watchdogInterval = int(os.environ.pop("WATCHDOG_USEC")) / 2000000
+        return
+
+    path = os.environ.get("NOTIFY_SOCKET", "")
+    if path == "": # If there is no notify socket
+        return
+
+    if path.startswith("@"): # If the socket is in the abstract namespace
+        path = "\0" + path[1:]
+
+    try: # Try to...
+        notifySocket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        notifySocket.connect(path)
+    except OSError as error: # If we can't reach it
+        log(logNotice, "Can't connect to notify socket {} ({})", path, error)
+        notifySocket = None
+        return
+
+    if "WATCHDOG_USEC" in os.environ and os.environ.get("WATCHDOG_PID", str(os.getpid())) == str(os.getpid()): # If the watchdog is meant for us
+        watchdogInterval = int(os.environ["WATCHDOG_USEC"]) / 2000000 # Ping twice as often as needed
+        dprint("Pinging systemd's watchdog every {} seconds", watchdogInterval)
+
+def notifyService(message):
+    """Send a message (like "READY=1") to systemd's notify socket, if we have one."""
+    if notifySocket == None:
+        return
+
+    try: # Try to...
+        notifySocket.send(message.encode())
+    except OSError as error: # If systemd went away
+        dprint("Can't notify systemd ({})", error)
+
+def serviceStatus():
+    """Return a str describing our devices' layers and event rate for systemd's status."""
+    global lastStatusEvents
+
+    events = sum([device.eventCount for device in macroDeviceList])
+    rate = (events - lastStatusEvents) / statusInterval
+    lastStatusEvents = events
+
+    if paused == True:
+        return "Paused"
+
+    if supervising == True: # If our devices are handled by workers
+        return f"{len([worker for worker in workers.values() if worker[0].poll() == None])} of {len(workers)} workers running"
+
+    layers = ", ".join([f"{device.name}: {device.currentLayer}" for device in macroDeviceList]) or "No devices"
+    return f"{layers} ({rate:.1f} events/s)"
+
+def pingService():
+    """Ping systemd's watchdog and update our status when they are due, called from the loop so a hung loop stops pinging."""
+    global lastWatchdog, lastStatus
+
+    if notifySocket == None:
+        return
+
+    now = time.time()
+    if not watchdogInterval == None and now - lastWatchdog >= watchdogInterval: # If the watchdog wants a ping
+        notifyService("WATCHDOG=1")
+        lastWatchdog = now
+
+    if now - lastStatus >= statusInterval: # If it's time for a status update
+        notifyService("STATUS=" + serviceStatus())
+        lastStatus = now
+
+
+
+# Process priority
+
+normalPriority = None # The (affinity, nice level) we had before applyProcessPriority(), restored in commands we run
+
+def applyProcessPriority():
+    """Apply the realtimePriority, niceLevel, cpuAffinity and lockMemory settings to this process so the loop isn't descheduled or paged out on busy hosts."""
+    global normalPriority
+    cpu = int(os.environ.pop("KEEBIE_CPU", settings["cpuAffinity"])) # Workers are given a CPU of their own by their supervisor
+
+    if not settings["niceLevel"] == 0 or cpu >= 0: # If commands will need them restored (SCHED_RESET_ON_FORK handles the rest)
+        normalPriority = (os.sched_getaffinity(0), os.getpriority(os.PRIO_PROCESS, 0)) # Remember what commands should run with
+
+    if not settings["niceLevel"] == 0: # If we should change our nice level
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, settings["niceLevel"])
+            dprint("Set nice level {}", settings['niceLevel'])
+        except OSError as error: # Lowering it needs CAP_SYS_NICE (or a high enough RLIMIT_NICE)
+            log(logNotice, "Can't set nice level {} ({})", settings['niceLevel'], error)
+
+    if settings["realtimePriority"] > 0: # If we should be scheduled in real time
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK, os.sched_param(settings["realtimePriority"])) # Children go back to normal scheduling
+            dprint("Set SCHED_FIFO priority {}", settings['realtimePriority'])
+        except OSError as error: # This needs CAP_SYS_NICE (or a high enough RLIMIT_RTPRIO)
+            log(logNotice, "Can't set real time priority {} ({})", settings['realtimePriority'], error)
+
+    if cpu >= 0: # If we should be pinned to a CPU
+        try:
+            os.sched_setaffinity(0, {cpu, })
+            dprint("Pinned to CPU {}", cpu)
+        except OSError as error: # If there is no such CPU (or we may not use it)
+            log(logNotice, "Can't pin to CPU {} ({})", cpu, error)
+
+    if settings["lockMemory"] == True: # If we should keep all our memory in RAM
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(1 | 2) == 0: # MCL_CURRENT | MCL_FUTURE, locks aren't inherited by children
+            dprint("Locked memory")
+        else: # This needs CAP_IPC_LOCK (or a high enough RLIMIT_MEMLOCK)
+            log(logNotice, "Can't lock memory ({})", os.strerror(ctypes.get_errno()))
+
+def commandPriority():
+    """Run in children before they exec commands, restore the affinity and nice level we had before applyProcessPriority()."""
+    if normalPriority == None: # If we never changed them
+        return
+
+    affinity, nice = normalPriority
+    os.sched_setaffinity(0, affinity)
+
+    if os.getpriority(os.PRIO_PROCESS, 0) < nice: # Raising a nice level is always allowed
+        os.setpriority(os.PRIO_PROCESS, 0, nice)
+
+
+
+# Device sharding
+
+workerShard = None # In a worker process, the name of the shard of devices it handles
+supervising = False # Whether we are a supervisor running a worker process for every shard
+workers = {} # A dict of [Popen, start time, notify socket, ready, last message time] of worker processes by shard name
+workerRestartDelay = 1 # Seconds a shard's worker must have run before it is restarted right away when it exits, otherwise the restart waits this long
+workerHeartbeatInterval = 1 # Seconds between the heartbeats workers send us like they would ping systemd's watchdog
+workerHangTimeout = 5 # Seconds a worker may go without a heartbeat (or without getting ready) before it is considered hung and restarted
+
+def deviceShard(device): # Return the name of the shard a macroDevice belongs to, devices in the same group must share a process (and ledger)
+    return device.groupName or device.name
+
+def startWorker(shard):
+    """Start a worker process running the loop for a shard of our devices."""
+    command = [sys.executable, os.path.abspath(sys.argv[0]), "--worker", shard]
+    command += ["--verbose", ] * printDebugs + ["--quiet", ] * quietMode + ["--log-json", ] * jsonLogs # Workers log like we do
+
+    notifySockets = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) # The worker tells us when it's ready and that it's alive, like it would tell systemd
+    notifySockets[0].setblocking(False)
+
+    environment = {name: value for name, value in os.environ.items() if not name in ("NOTIFY_SOCKET", "WATCHDOG_USEC", "WATCHDOG_PID")} # Only we talk to systemd
+    environment["KEEBIE_NOTIFY_FD"] = str(notifySockets[1].fileno())
+    environment["WATCHDOG_USEC"] = str(workerHeartbeatInterval * 2000000) # setupNotify() pings twice as often as asked
+    if settings["cpuAffinity"] >= 0: # If keebie should be pinned, pin each worker to a CPU of its own (as far as there are enough)
+        environment["KEEBIE_CPU"] = str(workerCpu(shard))
+
+    qprint("starting worker for {}", shard)
+    if shard in workers: # If we are replacing a worker
+        workers[shard][2].close()
+    workers[shard] = [subprocess.Popen(command, env=environment, pass_fds=[notifySockets[1].fileno(), ]), time.time(), notifySockets[0], False, time.time()]
+    notifySockets[1].close() # The worker has its own copy
+
+def workerCpu(shard):
+    """Return the CPU a shard's worker is pinned to, shards are spread over the CPUs we may use starting with cpuAffinity."""
+    cpus = sorted(os.sched_getaffinity(0))
+    cpus = [cpu for cpu in cpus if cpu >= settings["cpuAffinity"]] + [cpu for cpu in cpus if cpu < settings["cpuAffinity"]] # Start with cpuAffinity and wrap around
+    shards = sorted(set([deviceShard(device) for device in macroDeviceList]))
+
+    return cpus[shards.index(shard) % len(cpus)]
+
+def readWorkers():
+    """Note which workers are ready and when we last heard from them."""
+    for shard, worker in workers.items():
+        while True: # Until we've read all its messages
+            try: # Try to...
+                message = worker[2].recv(4096)
+            except BlockingIOError: # If there are no more
+                break
+
+            worker[4] = time.time()
+            if message == b"READY=1" and worker[3] == False:
+                worker[3] = True
+                dprint("Worker for {} is ready", shard)
+
+def signalWorkers(signum):
+    """Send a signal to all running worker processes."""
+    for worker in workers.values():
+        if worker[0].poll() == None:
+            os.kill(worker[0].pid, signum)
+
+def stopWorkers():
+    """Stop all worker processes and wait for them to clean up."""
+    signalWorkers(signal.SIGINT) # Workers end() on SIGINT like any loop
+
+    for shard, worker in workers.items():
+        try: # Try to...
+            worker[0].wait(2) # Give it time to ungrab its devices
+        except subprocess.TimeoutExpired: # If it doesn't stop
+            log(logNotice, "Worker for {} didn't stop, killing it", shard)
+            worker[0].kill()
+
+        worker[2].close()
+
+    workers.clear()
+
+def superviseWorkers():
+    """Start workers for new shards, stop workers of removed shards, and restart workers that exited or hung."""
+    shards = set([deviceShard(device) for device in macroDeviceList])
+    readWorkers()
+
+    for shard in list(workers.keys()):
+        if not shard in shards: # If the shard's devices were removed
+            process, started, notifySocket = workers.pop(shard)[:3]
+            notifySocket.close()
+            if process.poll() == None:
+                os.kill(process.pid, signal.SIGINT)
+
+        elif workers[shard][0].poll() == None and time.time() - workers[shard][4] > workerHangTimeout: # If its worker stopped sending heartbeats
+            log(logNotice, "Worker for {} hung, killing it", shard)
+            workers[shard][0].kill()
+            workers[shard][0].wait()
+
+    for shard in shards:
+        if not shard in workers: # If the shard is new
+            startWorker(shard)
+
+        elif not workers[shard][0].poll() == None: # If its worker exited
+            if time.time() - workers[shard][1] < workerRestartDelay: # If it crashed right after starting
+                continue # Let it rest a bit so a broken device doesn't spin
+
+            log(logNotice, "Worker for {} exited with {}, restarting it", shard, workers[shard][0].returncode)
+            startWorker(shard)
+
+def workersReady():
+    """Return True if the workers of all shards have grabbed their devices."""
+    return all([worker[3] == True for worker in workers.values()])
+
+def supervise():
+    """Run the devices in worker processes, one per shard (a device, or a group of devices), and restart them when they exit. Never returns."""
+    global supervising
+    supervising = True
+
+    superviseWorkers() # Start all workers
+    ready = False # Whether we told systemd we're up
+
+    while True : # Enter an infinite loop
+        if handoverRequested == True: # If a new instance wants to take over
+            handOver() # Stop our workers and let it
+
+        if paused == False: # If we are not paused
+            superviseWorkers() # Keep our workers running, restarting hung ones
+
+        if ready == False and workersReady(): # Once every worker has grabbed its devices
+            notifyService("READY=1") # Tell systemd (if it started us) that macros are live
+            ready = True
+
+        pingService() # Let systemd know we're alive
+
+        time.sleep(workerRestartDelay / 4)
+
+
+
+# Restart handover
+
+handoverPath = os.environ.get("XDG_RUNTIME_DIR", dataDir.rstrip("/")) + "/keebie.handover" # A path where a new instance listens for the devices of a running one
+handoverSignal = signal.SIGRTMIN + 1 # The signal asking a running instance to hand its devices over
+handoverTimeout = 5 # Seconds to wait for a running instance to hand its devices over
+handoverRequested = False # Whether a new instance asked us to hand our devices over
+handedOver = {} # A dict of (grabbed fd, state dict) handed over to us by device name, used up as devices are grabbed
+
+def handoverHandler(signal, frame):
+    """Note that a new instance wants our devices, the loop hands them over once it's safe to do so."""
+    global handoverRequested
+    handoverRequested = True
+
+def handOver():
+    """Send our grabbed devices and their state to a new instance listening on handoverPath and exit without ungrabbing them."""
+    global handoverRequested
+    qprint("Handing devices over to a new instance...")
+
+    devices = [device for device in macroDeviceList if not device.device == None] if paused == False and supervising == False else [] # Paused (or supervising) instances have nothing grabbed
+    payload = json.dumps({"devices": [[device.name, device.handoverState()] for device in devices], "watchdog": watchdogInterval, "paused": paused}).encode() # systemd only tells its main process about the watchdog
+
+    try: # Try to...
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as handoverSocket:
+            handoverSocket.connect(handoverPath)
+            socket.send_fds(handoverSocket, [payload, ], [device.device.fd for device in devices]) # Pass the fds along with our state
+            handoverSocket.shutdown(socket.SHUT_WR)
+
+            if paused == True: # Whatever paused us holds our devices, so the new instance refuses the handover and we stay paused
+                handoverRequested = False
+                log(logNotice, "Paused, refusing to hand devices over")
+                return
+
+            if not handoverSocket.recv(1) == b"\0": # Wait until the new instance has our fds
+                raise OSError("the new instance failed to take them")
+
+    except OSError as error: # If the new instance went away
+        handoverRequested = False
+        log(logNotice, "Can't hand devices over ({}), carrying on", error)
+        return
+
+    stopWorkers() # Workers can't be handed over, the new instance starts its own
+
+    if not state == None: # Leave everything but our devices (and their grabs) to the new instance
+        state.close()
+    closeVirtualKeyboard()
+    removePid()
+
+    sys.exit(0) # Exit without ungrabbing, our fds close but the new instance's copies keep the grabs
+
+def receiveHandover():
+    """Ask a running instance to hand its devices over and fill handedOver with them. Return True if we got a handover (possibly of no devices)."""
+    global watchdogInterval
+
+    try: # Try to...
+        checkPid() # Check if an instance is running
+        pid = getPid()
+    except (FileNotFoundError, ProcessLookupError): # If none is
+        log(logNotice, "No running keebie instance to take over from, starting normally")
+        return False
+
+    if getSignalVersion() < 1: # If the instance would be killed by handoverSignal rather than handle it
+        log(logNotice, "The running keebie instance is too old to hand its devices over, stop it and start keebie again")
+        return False
+
+    if os.path.exists(handoverPath): # Remove a socket left by a failed handover
+        os.remove(handoverPath)
+
+    fds = [] # The fds handed to us, closed again if the handover fails
+    try: # Try to...
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listenSocket:
+            listenSocket.bind(handoverPath)
+            listenSocket.listen(1)
+            listenSocket.settimeout(handoverTimeout)
+
+            os.kill(pid, handoverSignal) # Ask the running instance for its devices
+
+            connection, address = listenSocket.accept()
+            with connection:
+                connection.settimeout(handoverTimeout)
+                data, fds, flags, address = socket.recv_fds(connection, 65536, 256) # Get our fds and the start of the state
+                chunk = data
+                while not chunk == b"": # Read the rest of the state
+                    chunk = connection.recv(65536)
+                    data += chunk
+                handover = json.loads(data)
+
+                if handover.get("paused", False) == True: # If something paused the running instance it holds the devices, we couldn't grab them
+                    log(logNotice, "The running keebie instance is paused, resume it and try again")
+                    return False
+
+                devices = handover["devices"]
+                if not notifySocket == None: # If systemd is watching the old instance, watch us instead before it exits
+                    watchdogInterval = handover["watchdog"]
+                    notifyService(f"MAINPID={os.getpid()}")
+
+                connection.send(b"\0") # Let the old instance exit
+
+    except (OSError, ValueError, KeyError) as error: # If it doesn't answer, the handover broke off or its state is unreadable
+        for grabbedFd in fds: # Let go of whatever we got, the old instance keeps its grabs
+            os.close(grabbedFd)
+
+        if isinstance(error, socket.timeout):
+            log(logNotice, "The running keebie instance didn't hand its devices over")
+        else:
+            log(logNotice, "Taking over from the running keebie instance failed ({})", error)
+        return False
+
+    finally: # Whatever happened
+        if os.path.exists(handoverPath): # Don't leave the socket behind
+            os.remove(handoverPath)
+
+    for (name, handoverState), grabbedFd in zip(devices, fds):
+        handedOver[name] = (grabbedFd, handoverState)
+
+    for attempt in range(0, handoverTimeout * 100): # Wait for the old instance to exit (and remove its PID file)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.01)
+
+    dprint("Devices handed over: {}", list(handedOver.keys()))
+
+    return True
+
+def detachReload():
+    """If systemd runs us as the unit's ExecReload, fork so the reload can finish while we carry on as the unit's main process. Return a fd to close once we took over, or None."""
+    if os.environ.get("NOTIFY_SOCKET", "") == "": # If we were started from a shell
+        return None
+
+    readFd, writeFd = os.pipe()
+    if os.fork() > 0: # If we are the reload command
+        os.close(writeFd)
+        os._exit(0 if os.read(readFd, 1) == b"\0" else 1) # Finish the reload once our child took over (or failed if it died)
+
+    os.close(readFd)
+    return writeFd
 
 
 
@@ -1203,6 +3782,30 @@ parser.add_argument("--stop", "-S", help="Stop a running keebie instance that is
 
 parser.add_argument("--install", "-I", help="Install default files to your home's .config/ directory", action="store_true")
 
+parser.add_argument("--import", help="Merge bindings, vars and LEDs from a CSV or JSON lines file (- for stdin) into --layer", default=False, metavar="file", dest="importFile")
+
+parser.add_argument("--export", help="Dump the bindings, vars and LEDs of --layer as CSV or JSON lines (to stdout if no file is given)", nargs="?", default=False, const="-", metavar="file")
+
+parser.add_argument("--layer", help="Layer used by --import and --export (default.json by default)", default="default.json", metavar="layer")
+
+parser.add_argument("--check", help="Check all layer files for problems and save them compiled for faster startup", action="store_true")
+
+parser.add_argument("--provision", help="Set up all devices listed in a JSON manifest file (- for stdin) without prompting", default=False, metavar="manifest")
+
+parser.add_argument("--overwrite", help="Let --import replace bindings and vars that already exist in the layer (and --provision replace existing devices)", action="store_true")
+
+parser.add_argument("--state", help="Print the state published by a running keebie instance as JSON", action="store_true")
+
+parser.add_argument("--dump-log", help="Print the recent log records (including debug records) kept in memory by a running keebie instance", action="store_true")
+
+parser.add_argument("--journal", help="Print the commands a running keebie instance ran with their exit status and timing, optionally only those whose device, layer, keys or command contain match", nargs="?", const="", default=None, metavar="match")
+
+parser.add_argument("--log-json", help="Print log output (and the records printed by --dump-log) as JSON lines", action="store_true")
+
+parser.add_argument("--restart", help="Take over the grabbed devices of a running keebie instance, so it can be restarted without keys leaking through", action="store_true")
+
+parser.add_argument("--worker", help=argparse.SUPPRESS, default=None, metavar="shard") # Used by a supervisor to start a worker for a shard of devices
+
 parser.add_argument("--verbose", "-v", help="Print extra debugging information", action="store_true")
 
 parser.add_argument("--quiet", "-q", help="Print less", action="store_true")
@@ -1210,13 +3813,20 @@ parser.add_argument("--quiet", "-q", help="Print less", action="store_true")
 args = parser.parse_args()
 
 printDebugs = args.verbose
-quietMode = args.quiet or args.print_keys
+quietMode = args.quiet or args.print_keys or args.export == "-" or args.state or args.dump_log or not args.journal == None
+jsonLogs = args.log_json
+workerShard = args.worker
+
+if not workerShard == None: # If we are a worker
+    statePath += "." + workerShard # Publish our state next to our supervisor's
+    journalPath = dataDir + f"journal-{workerShard}.log" # And journal next to the other workers (not as journal.log.<shard>, which rotation could clash with)
+    journalDumpPath += "." + workerShard # Our supervisor merges the dumps of its workers
 
 
 
 # Main code
 
-if not args.print_keys:
+if not (args.print_keys or args.export == "-" or args.state or args.dump_log or not args.journal == None or args.log_json or args.worker):
     print("Welcome to Keebie")
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -1282,27 +3892,88 @@ elif args.stop: # If the user passed --stop
 elif args.install: # If the user passed --install
     firstUses() # Perform first time setup
 
-else: # If the user passed nothing
+elif args.state: # If the user passed --state
     try:
-        savePid() # Try to save our PID to the PID file
+        print(json.dumps(readStates(), indent=3)) # Print the published state
+    except FileNotFoundError:
+        print("No running keebie instance has published its state")
 
-    except FileExistsError: # If the PID file already exists
-        try:
-            checkPid() # Check if it is valid, this will raise an error if it isn't
-            print("Another instance of keebie is already processing macros, exiting...") 
-            end()
+elif args.dump_log: # If the user passed --dump-log
+    sendDumpLog() # Print the log of a running keebie loop
+
+elif not args.journal == None: # If the user passed --journal
+    printJournal(args.journal) # Print the commands a running keebie loop ran
+
+elif args.check: # If the user passed --check
+    sys.exit(1 if checkLayers() > 0 else 0) # Check the layers, failing if any have errors
+
+elif args.provision: # If the user passed --provision
+    sendPause() # Ask a running keebie loop (if one exists) to pause so it will detect the new devices when we're done
+
+    end(0 if provisionDevices(args.provision, args.overwrite) else 1) # Set up the devices in the manifest, failing if nothing was set up
+
+elif args.importFile: # If the user passed --import
+    sys.exit(0 if importRecords(args.importFile, args.layer, args.overwrite) else 1) # Merge the file into the layer, failing if it was aborted
+
+elif args.export: # If the user passed --export
+    sys.exit(0 if exportRecords(args.layer, args.export) else 1) # Dump the layer, failing if it can't be read
+
+else: # If the user passed nothing (or --restart, or we are a worker)
+    tookOver = False # Whether a running instance handed its devices to us
+    reloadFd = detachReload() if args.restart else None # The fd telling systemd's reload command we took over
 
-        except ProcessLookupError: # If the PID file pointed to an invalid PID
-            savePid() # Save our PID to the PID file (which checkPid() will have removed)
+    setupNotify() # Connect to systemd if it started us (or the instance we take over from)
+
+    if args.restart: # If the user passed --restart
+        tookOver = receiveHandover() # Take over the running instance's devices
+
+    if not reloadFd == None: # Let the reload finish
+        os.write(reloadFd, b"\0")
+        os.close(reloadFd)
 
     signal.signal(signal.SIGUSR1, pause) # Bind SIGUSR1 to pause()
     signal.signal(signal.SIGUSR2, resume) # Bind SIGUSR2 to remove()
+    signal.signal(logDumpSignal, dumpLogHandler) # Bind logDumpSignal to dumpLogHandler()
+    signal.signal(journalDumpSignal, dumpJournalHandler) # Bind journalDumpSignal to dumpJournalHandler()
+    signal.signal(handoverSignal, handoverHandler) # Bind handoverSignal to handoverHandler(), before our PID file says we handle it
+
+    if workerShard == None: # Workers leave the PID file to their supervisor
+        try:
+            savePid() # Try to save our PID to the PID file
+
+        except FileExistsError: # If the PID file already exists
+            try:
+                checkPid() # Check if it is valid, this will raise an error if it isn't
+                log(logNotice, "Another instance of keebie is already processing macros, exiting...") 
+                end()
+
+            except ProcessLookupError: # If the PID file pointed to an invalid PID
+                savePid() # Save our PID to the PID file (which checkPid() will have removed)
 
-    time.sleep(.5)
+    if workerShard == None and settings["shardDevices"] == True: # If our devices should be handled by worker processes
+        supervise()
+
+    loadLayerCache() # Load layers compiled by --check, if any
+
+    if tookOver == False: # If our devices aren't grabbed already
+        time.sleep(.5)
+    applyProcessPriority() # Ask for real time scheduling and such if our settings want it
     grabMacroDevices() # Grab all the devices
 
+    notifyService("READY=1") # Tell systemd (if it started us) that macros are live
+
     while True : # Enter an infinite loop
+        if handoverRequested == True: # If a new instance wants our devices
+            handOver() # Give them to it between reads, so our ledgers are consistent
+
         if paused == False: # If we are not paused
             readDevices() # Read all devices and process the keycodes
+            scheduler.run() # Run any timers that are due
+            reapCommands() # Clean up after finished background commands
+            reapVars() # Cache the values of dynamic vars that finished refreshing
+            checkLayerTables() # Rebuild flattened layers if their files changed
+
+        publishState() # Let status bars know what we're up to
+        pingService() # And systemd that we're alive
     
-        time.sleep(settings["loopDelay"]) # Sleep so we don't eat the poor little CPU
+        time.sleep(scheduler.sleepTime(settings["loopDelay"])) # Sleep so we don't eat the poor little CPU, but wake up for timers